@@ -0,0 +1,421 @@
+#!/usr/bin/python3
+
+import json
+import os
+import platform
+import random
+import resource
+import shlex
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import sync_shared
+
+# Directory of the server and client scripts
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# Scenarios in the order they run
+SCENARIOS = ["small-files", "large-files", "zero-copy", "edit-latency", "edit-during-sync", "delete-storm", "rename-storm", "scan"]
+# Seconds a scenario may take before it counts as failed
+SCENARIO_TIMEOUT = 600
+# Seconds between two checks if the output directory caught up
+POLL_INTERVAL = 0.01
+# Seconds to wait for a process to stop after ctrl+c
+STOP_TIMEOUT = 10
+
+
+def log(message: str):
+    # Progress goes to stderr, so the results on stdout stay valid JSON
+    print(f"[{time.strftime('%X')}] {message}", file=sys.stderr)
+
+def snapshot(root: str) -> dict:
+    """describe a directory tree by the size and mtime of its files, the server keeps the mtime of the client"""
+    tree = {}
+    for directory, dirs, files in os.walk(root):
+        if directory == root and sync_shared.METADATA_DIRECTORY in dirs:
+            dirs.remove(sync_shared.METADATA_DIRECTORY)
+        for name in dirs:
+            tree[os.path.relpath(os.path.join(directory, name), root)] = None
+        for name in files:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            tree[os.path.relpath(path, root)] = (stat.st_size, stat.st_mtime_ns)
+    return tree
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(("localhost", 0))
+        return probe.getsockname()[1]
+
+def summarize(samples: list) -> dict:
+    """the distribution of a list of seconds in milliseconds"""
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "min_ms": samples[0] * 1000,
+        "median_ms": statistics.median(samples) * 1000,
+        "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+        "max_ms": samples[-1] * 1000
+    }
+
+
+class Process:
+    """a server or client started from its script with its output written to a log file"""
+
+    def __init__(self, script: str, arguments: list, log_path: str):
+        self.log_path = log_path
+        self._log = open(log_path, 'w')
+        # Unbuffered, so the log can be watched while the process runs
+        environment = {**os.environ, "PYTHONUNBUFFERED": "1"}
+        self.process = subprocess.Popen([sys.executable, os.path.join(SCRIPT_DIRECTORY, script), *arguments],
+            stdout=self._log, stderr=subprocess.STDOUT, env=environment)
+
+    def has_logged(self, text: str) -> bool:
+        with open(self.log_path, 'r', errors='replace') as f:
+            return text in f.read()
+
+    def wait_for(self, text: str, timeout: float):
+        """wait until the process logged `text`"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.has_logged(text):
+                return
+            if self.process.poll() is not None:
+                raise RuntimeError(f"{os.path.basename(self.log_path)} stopped before logging '{text}'")
+            time.sleep(POLL_INTERVAL)
+        raise TimeoutError(f"{os.path.basename(self.log_path)} didn't log '{text}' in {timeout}s")
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self._log.close()
+
+
+class Bench:
+    """runs the scenarios against a server and client on a loopback port"""
+
+    def __init__(self):
+        self._parse_args()
+        self.random = random.Random(self.seed)
+
+    def _parse_args(self):
+        """parse cli arguments"""
+        parser = ArgumentParser(description="Measure the throughput and latency of syncing with a server and client on a loopback port. The results are printed as JSON")
+        parser.add_argument('-s', '--scenario', action='append', choices=SCENARIOS, help="a scenario to run, can be given more than once. Defaults to all of them")
+        parser.add_argument('--files', default=2000, type=int, help="the amount of small files to sync. Defaults to 2000")
+        parser.add_argument('--file-size', default=4096, type=int, help="the size of the small files in bytes. Defaults to 4096")
+        parser.add_argument('--large-files', default=3, type=int, help="the amount of large files to sync. Defaults to 3")
+        parser.add_argument('--large-size', default=64 * 1024 * 1024, type=int, help="the size of the large files in bytes. Defaults to 64MB")
+        parser.add_argument('--edits', default=20, type=int, help="the amount of edits to measure the latency of. Defaults to 20")
+        parser.add_argument('--seed', default=0, type=int, help="the seed of the generated file contents. Defaults to 0")
+        parser.add_argument('--client-args', default="", help="extra options for the client, e.g. '--compression auto'")
+        parser.add_argument('--server-args', default="", help="extra options for the server, e.g. '--no-splice'")
+        parser.add_argument('-o', '--output', help="the file to write the results to. Defaults to stdout")
+
+        args = parser.parse_args()
+        self.scenarios = args.scenario or SCENARIOS
+        self.files = args.files
+        self.file_size = args.file_size
+        self.large_files = args.large_files
+        self.large_size = args.large_size
+        self.edits = args.edits
+        self.seed = args.seed
+        self.client_args = shlex.split(args.client_args)
+        self.server_args = shlex.split(args.server_args)
+        self.output = args.output
+
+    def run(self) -> dict:
+        results = {
+            "protocol-version": sync_shared.PROTOCOL_VERSION,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "options": {
+                "files": self.files,
+                "file-size": self.file_size,
+                "large-files": self.large_files,
+                "large-size": self.large_size,
+                "edits": self.edits,
+                "seed": self.seed,
+                "client-args": self.client_args,
+                "server-args": self.server_args
+            },
+            "scenarios": {}
+        }
+        for scenario in self.scenarios:
+            log(f"Running {scenario}...")
+            with tempfile.TemporaryDirectory(prefix="sync_bench_") as directory:
+                try:
+                    results["scenarios"][scenario] = getattr(self, "_" + scenario.replace('-', '_'))(directory)
+                except (RuntimeError, TimeoutError) as e:
+                    log(f"{scenario} failed: {e}")
+                    results["scenarios"][scenario] = {"error": str(e)}
+        return results
+
+    # Scenarios
+
+    def _small_files(self, directory: str) -> dict:
+        """initial sync of many small files"""
+        input_path = self._prepare(directory)
+        self._write_small_files(input_path, self.files)
+
+        seconds = self._time_initial_sync(directory)
+        size = self.files * self.file_size
+        return {"seconds": seconds, "files_per_second": self.files / seconds, "bytes_per_second": size / seconds}
+
+    def _large_files(self, directory: str) -> dict:
+        """initial sync of a few large files"""
+        input_path = self._prepare(directory)
+        for number in range(self.large_files):
+            with open(os.path.join(input_path, f"large{number}.bin"), 'wb') as f:
+                self._write_random(f, self.large_size)
+
+        seconds = self._time_initial_sync(directory)
+        size = self.large_files * self.large_size
+        return {"seconds": seconds, "bytes_per_second": size / seconds}
+
+    def _zero_copy(self, directory: str) -> dict:
+        """initial sync of the large files once with read and send loops on both sides and once with sendfile and
+        splice. Splice is only used when the server writes on the receiving thread, so both runs do that"""
+        results = {}
+        for (name, client_args, server_args) in [("loops", ["--no-sendfile"], ["--write-buffers", "0", "--no-splice"]),
+                                                 ("zero-copy", [], ["--write-buffers", "0"])]:
+            run_directory = os.path.join(directory, name)
+            input_path = self._prepare(run_directory)
+            for number in range(self.large_files):
+                with open(os.path.join(input_path, f"large{number}.bin"), 'wb') as f:
+                    self._write_random(f, self.large_size)
+
+            before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            seconds = self._time_initial_sync(run_directory, client_args, server_args)
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            size = self.large_files * self.large_size
+            cpu_seconds = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+            results[name] = {"seconds": seconds, "bytes_per_second": size / seconds, "cpu_seconds": cpu_seconds}
+        return results
+
+    def _edit_latency(self, directory: str) -> dict:
+        """time from saving a file on the client to the server writing it"""
+        input_path = self._prepare(directory)
+        self._write_small_files(input_path, min(self.files, 100))
+        (server, client) = self._start(directory)
+        try:
+            self._wait_synced(directory)
+            samples = []
+            for number in range(self.edits):
+                path = os.path.join("edits", f"file{number % 5}.txt")
+                with open(self._makedirs(input_path, path), 'wb') as f:
+                    self._write_random(f, self.file_size)
+                expected = os.stat(os.path.join(input_path, path))
+                start = time.perf_counter()
+                self._wait_for_file(os.path.join(directory, "output", path), expected)
+                samples.append(time.perf_counter() - start)
+        finally:
+            self._stop(server, client)
+        return summarize(samples)
+
+    def _edit_during_sync(self, directory: str) -> dict:
+        """time from saving a file on the client to the server writing it, while the initial sync sends the large files"""
+        input_path = self._prepare(directory)
+        for number in range(self.large_files):
+            with open(os.path.join(input_path, f"large{number}.bin"), 'wb') as f:
+                self._write_random(f, self.large_size)
+        (server, client) = self._start(directory)
+        try:
+            samples = []
+            # Only edits that arrive before the sync is done count
+            while len(samples) < self.edits and not client.has_logged("Syncing is done"):
+                path = os.path.join("edits", f"file{len(samples) % 5}.txt")
+                with open(self._makedirs(input_path, path), 'wb') as f:
+                    self._write_random(f, self.file_size)
+                expected = os.stat(os.path.join(input_path, path))
+                start = time.perf_counter()
+                self._wait_for_file(os.path.join(directory, "output", path), expected)
+                samples.append(time.perf_counter() - start)
+            self._wait_synced(directory)
+        finally:
+            self._stop(server, client)
+        if not samples:
+            raise RuntimeError("The sync was done before the first edit, use larger or more large files")
+        return summarize(samples)
+
+    def _delete_storm(self, directory: str) -> dict:
+        """time until the server removed many files that were deleted at once"""
+        input_path = self._prepare(directory)
+        self._write_small_files(input_path, self.files)
+        (server, client) = self._start(directory)
+        try:
+            self._wait_synced(directory)
+            start = time.perf_counter()
+            for name in sorted(os.listdir(input_path)):
+                if name != sync_shared.METADATA_DIRECTORY:
+                    for root, _, files in os.walk(os.path.join(input_path, name)):
+                        for file in files:
+                            os.remove(os.path.join(root, file))
+            seconds = self._wait_synced(directory, start)
+        finally:
+            self._stop(server, client)
+        return {"seconds": seconds, "files_per_second": self.files / seconds}
+
+    def _rename_storm(self, directory: str) -> dict:
+        """time until the server applied many renames of files and directories"""
+        input_path = self._prepare(directory)
+        self._write_small_files(input_path, self.files)
+        (server, client) = self._start(directory)
+        try:
+            self._wait_synced(directory)
+            start = time.perf_counter()
+            renames = 0
+            for name in sorted(os.listdir(input_path)):
+                if name == sync_shared.METADATA_DIRECTORY:
+                    continue
+                path = os.path.join(input_path, name)
+                for file in sorted(os.listdir(path))[::2]:
+                    os.rename(os.path.join(path, file), os.path.join(path, "renamed-" + file))
+                    renames += 1
+                os.rename(path, path + "-renamed")
+                renames += 1
+            seconds = self._wait_synced(directory, start)
+        finally:
+            self._stop(server, client)
+        return {"seconds": seconds, "renames": renames, "renames_per_second": renames / seconds}
+
+    def _scan(self, directory: str) -> dict:
+        """entries per second of walking the tree with os.walk and a stat per file, and of the threads of scan_tree"""
+        input_path = self._prepare(directory)
+        self._write_small_files(input_path, self.files)
+
+        def walk() -> int:
+            count = 0
+            for root, dirs, files in os.walk(input_path):
+                count += len(dirs)
+                for name in files:
+                    os.stat(os.path.join(root, name))
+                    count += 1
+            return count
+
+        def scan() -> int:
+            return sum(1 for _ in sync_shared.scan_tree(input_path))
+
+        # The first walk fills the cache, so both are measured the same way
+        walk()
+        results = {"workers": sync_shared.SCAN_WORKERS}
+        for (name, function) in (("walk", walk), ("scan", scan)):
+            start = time.perf_counter()
+            entries = function()
+            seconds = time.perf_counter() - start
+            results[name] = {"entries": entries, "seconds": seconds, "entries_per_second": entries / seconds}
+        return results
+
+    # Helpers
+
+    def _prepare(self, directory: str) -> str:
+        os.makedirs(os.path.join(directory, "output"))
+        input_path = os.path.join(directory, "input")
+        os.makedirs(input_path)
+        return input_path
+
+    def _makedirs(self, root: str, path: str) -> str:
+        os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+        return os.path.join(root, path)
+
+    def _write_small_files(self, input_path: str, count: int):
+        """spread the files over directories like a source tree"""
+        for number in range(count):
+            path = self._makedirs(input_path, os.path.join(f"dir{number % 50}", f"file{number}.txt"))
+            with open(path, 'wb') as f:
+                self._write_random(f, self.file_size)
+
+    def _write_random(self, f, size: int):
+        """write reproducible contents that compress about as well as source code"""
+        while size > 0:
+            count = min(size, 1024 * 1024)
+            f.write(self.random.randbytes(count // 2).hex().encode()[:count])
+            size -= count
+
+    def _start(self, directory: str, watch: bool = True, client_args: list[str] = (), server_args: list[str] = ()) -> tuple[Process, Process]:
+        """start the server and the client, with `client_args` and `server_args` after the ones of the command line.
+        Changes are only seen once the client watches the input directory, so wait for that with `watch`"""
+        port = free_port()
+        server = Process("sync_server.py", ["-o", os.path.join(directory, "output"), "-p", str(port), *self.server_args, *server_args], os.path.join(directory, "server.log"))
+        try:
+            server.wait_for("Listening on", SCENARIO_TIMEOUT)
+            client = Process("sync_client.py", ["-i", os.path.join(directory, "input"), "-p", str(port), *self.client_args, *client_args], os.path.join(directory, "client.log"))
+        except Exception:
+            server.stop()
+            raise
+        if watch:
+            try:
+                client.wait_for("Watching directory", SCENARIO_TIMEOUT)
+            except Exception:
+                self._stop(server, client)
+                raise
+        return (server, client)
+
+    def _stop(self, server: Process, client: Process):
+        client.stop()
+        server.stop()
+
+    def _time_initial_sync(self, directory: str, client_args: list[str] = (), server_args: list[str] = ()) -> float:
+        start = time.perf_counter()
+        (server, client) = self._start(directory, False, client_args, server_args)
+        try:
+            return self._wait_synced(directory, start)
+        finally:
+            self._stop(server, client)
+
+    def _wait_synced(self, directory: str, start: float = None) -> float:
+        """wait until the output looks like the input and return the seconds since `start`"""
+        if start is None:
+            start = time.perf_counter()
+        input_path = os.path.join(directory, "input")
+        output_path = os.path.join(directory, "output")
+        expected = snapshot(input_path)
+        deadline = time.monotonic() + SCENARIO_TIMEOUT
+        while snapshot(output_path) != expected:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"The output didn't catch up in {SCENARIO_TIMEOUT}s")
+            time.sleep(POLL_INTERVAL)
+        return time.perf_counter() - start
+
+    def _wait_for_file(self, path: str, expected: os.stat_result):
+        deadline = time.monotonic() + SCENARIO_TIMEOUT
+        while True:
+            try:
+                stat = os.stat(path)
+                if (stat.st_size, stat.st_mtime_ns) == (expected.st_size, expected.st_mtime_ns):
+                    return
+            except FileNotFoundError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"'{path}' didn't arrive in {SCENARIO_TIMEOUT}s")
+            time.sleep(POLL_INTERVAL / 10)
+
+
+def main():
+    bench = Bench()
+    results = bench.run()
+
+    output = json.dumps(results, indent=2)
+    if bench.output:
+        with open(bench.output, 'w') as f:
+            f.write(output + '\n')
+        log(f"Results written to {bench.output}")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,101 @@
 #!/usr/bin/python3
 
+import hashlib
 import json
-from threading import Thread
+import re
+import sqlite3
+from queue import Empty, Queue
+from threading import Condition, Event, Lock, Thread, local
 import time
 import os
 import socket
 import sys
+import tempfile
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from argparse import ArgumentParser
+from contextlib import contextmanager
 from genericpath import isfile
-import rich.progress
+from shutil import copy2, rmtree
 
 import sync_shared
 
-# Fix VSCode duplciate modified event messages (for small sized files < 50kb or around 800 lines of code)
-DUPLICATE_DELAY = 0.5
+# Name of the index database inside the metadata directory
+INDEX_NAME = 'index.db'
+# Name of the file inside the metadata directory that receives the files changed on the server
+INCOMING_NAME = 'incoming'
+# Name of the directory inside the metadata directory with the snapshots of files that are being sent
+SNAPSHOT_DIRECTORY = 'snapshots'
+# Files from this size are sent from a reflink snapshot, if the filesystem supports it
+SNAPSHOT_MIN_SIZE = 8 * 1024 * 1024
+# Times a file that changed while it was sent is sent again right away, after that it waits for the next quiet period
+STALE_RETRIES = 1
+# Maximum amount of paths kept in the index, the least recently used paths are removed first
+INDEX_MAX_ENTRIES = 1000000
+# Prune the index after this many writes
+INDEX_PRUNE_INTERVAL = 10000
+# Writes to the index during a batch are committed together once there are this many
+INDEX_COMMIT_INTERVAL = 1000
+# Default amount of connections that send files in parallel during the initial sync
+DEFAULT_STREAMS = 4
+# Amount of files that can wait for a free stream during the initial sync
+STREAM_QUEUE_SIZE = 256
+# Only open extra streams when at least this many files have to be sent
+STREAM_MIN_FILES = 8
+# Default seconds without new events before the collected events are sent
+DEFAULT_QUIET_PERIOD = 0.1
+# Maximum seconds events are held back when the directory keeps changing
+MAX_EVENT_DELAY = 2
+# Batches with more paths than this are sent as a complete sync with the manifest instead of one by one
+BATCH_SYNC_THRESHOLD = 1000
+# A sync sends the differences it found once there are this many, while the rest of the tree is still scanned
+SYNC_BATCH_SIZE = 1000
+# or once the oldest difference waited this many seconds, when the scan is slow
+SYNC_BATCH_DELAY = 1
+
+# Coalesced actions of the event queue
+ACTION_UPLOAD = "upload"
+ACTION_DIRECTORY = "directory"
+ACTION_DELETE = "delete"
+ACTION_MOVE = "move"
+# Ignore file that is read from the input directory when it exists
+IGNORE_FILE_NAME = '.syncignore'
+# Seconds to wait for the server to reply to a request like "manifest" or "signature"
+REQUEST_TIMEOUT = 300
+# Operations that can be sent over a connection before the server has to acknowledge the first one
+OPERATION_WINDOW = 64
+# Times an operation the server couldn't apply is sent again
+MAX_RETRIES = 3
+# Priorities of the scheduler: changes caught by the watcher go before the transfers of a sync
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BULK = "bulk"
+# Maximum seconds a bulk transfer waits for interactive changes before it sends its next chunk anyway
+MAX_PREEMPTION = 1
+
+sync_shared.metrics.describe("sync_client_bytes_sent_total", "counter", "bytes of file contents sent, after compression")
+sync_shared.metrics.describe("sync_client_files_sent_total", "counter", "files sent to the server")
+sync_shared.metrics.describe("sync_client_queue_depth", "gauge", "changes waiting in the event queue")
+sync_shared.metrics.describe("sync_client_event_latency_seconds", "histogram", "seconds from the first change of a batch until the server applied the batch")
+sync_shared.metrics.describe("sync_client_operations_in_flight", "gauge", "operations the server didn't acknowledge yet")
+sync_shared.metrics.describe("sync_client_ack_latency_seconds", "histogram", "seconds from sending an operation until the server acknowledged it")
+sync_shared.metrics.describe("sync_client_retransmits_total", "counter", "operations sent again because the server could not apply them")
+sync_shared.metrics.describe("sync_client_files_received_total", "counter", "files changed on the server that were written to the input directory")
+sync_shared.metrics.describe("sync_client_conflicts_total", "counter", "files that changed on the client and the server at the same time")
+sync_shared.metrics.describe("sync_client_deduplicated_total", "counter", "files the server made from contents it already had")
+sync_shared.metrics.describe("sync_client_deduplicated_bytes_total", "counter", "bytes that didn't have to be sent because the server already had them")
+sync_shared.metrics.describe("sync_client_ignored_events_total", "counter", "watchdog events of ignored paths that were skipped")
+sync_shared.metrics.describe("sync_client_ignored_paths_total", "counter", "ignored files and directories that were skipped while walking the input directory")
+sync_shared.metrics.describe("sync_client_ignored_bytes_total", "counter", "bytes of the ignored files that were skipped while walking the input directory")
+sync_shared.metrics.describe("sync_client_scanned_paths_total", "counter", "files and directories of the input directory that a sync compared with the server")
+sync_shared.metrics.describe("sync_client_stale_transfers_total", "counter", "files that changed while they were sent, the server threw these away")
+sync_shared.metrics.describe("sync_client_snapshots_total", "counter", "large files that were sent from a reflink snapshot")
+sync_shared.metrics.describe("sync_client_preempted_seconds_total", "counter", "seconds bulk transfers waited for interactive changes to be sent")
+sync_shared.metrics.describe("sync_client_throttled_seconds_total", "counter", "seconds transfers waited for the bandwidth limit of their priority")
+sync_shared.metrics.describe("sync_client_superseded_transfers_total", "counter", "transfers the server threw away because a newer transfer of the same file started")
 
 socket_handler: 'ClientSocket' = None
 
-def create_event_headers(event_type: str, directory:bool=None, source_path:str=None) -> str:
+def create_event_headers(event_type: str, directory:bool=None, source_path:str=None, destination_path:str=None) -> dict:
     event_headers = {
         "event-type": event_type
     }
@@ -27,118 +103,1123 @@ def create_event_headers(event_type: str, directory:bool=None, source_path:str=N
         event_headers["directory"] = directory
     if source_path is not None:
         event_headers["source-path"] = socket_handler.get_relative_path(source_path)
-    return json.dumps(event_headers)
+    if destination_path is not None:
+        event_headers["destination-path"] = socket_handler.get_relative_path(destination_path)
+    return event_headers
+
+class IgnoreRules:
+    """gitignore style patterns compiled once into regular expressions. Without negated patterns all rules are combined
+    into a single expression, otherwise the last rule that matches decides like in git. Like in git, nothing below an
+    ignored directory can be included again"""
+
+    def __init__(self, patterns: list):
+        # (expression, negated, only matches directories)
+        self.rules = []
+        for pattern in patterns:
+            pattern = pattern.rstrip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            negated = pattern.startswith('!')
+            if negated:
+                pattern = pattern[1:]
+            elif pattern.startswith('\\'):
+                pattern = pattern[1:]
+            directory_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            if pattern:
+                self.rules.append((_translate_pattern(pattern), negated, directory_only))
+
+        self._combined = None
+        if self.rules and not any(negated for (_, negated, _) in self.rules):
+            # Everything below a match is ignored as well, files only match the rules that aren't for directories
+            below = "|".join(expression for (expression, _, _) in self.rules)
+            files = "|".join(expression for (expression, _, directory_only) in self.rules if not directory_only) or "(?!)"
+            directories = "|".join(expression for (expression, _, directory_only) in self.rules if directory_only) or "(?!)"
+            self._combined = (re.compile(f"(?:{below})/.*|(?:{files})"), re.compile(directories))
+        self._rules = [(re.compile(expression), negated, directory_only) for (expression, negated, directory_only) in self.rules]
+
+    @classmethod
+    def load(cls, paths: list, patterns: list) -> 'IgnoreRules':
+        """read the patterns of the ignore files that exist and add the given patterns after them"""
+        lines = []
+        for path in paths:
+            if os.path.isfile(path):
+                with open(path, 'r', encoding=sync_shared.FORMAT) as f:
+                    lines += f.read().splitlines()
+        return cls(lines + list(patterns))
+
+    def __bool__(self) -> bool:
+        return bool(self.rules)
+
+    def is_ignored(self, relative_path: str, is_directory: bool) -> bool:
+        if self._combined is not None:
+            (any_path, directories) = self._combined
+            return any_path.fullmatch(relative_path) is not None or (is_directory and directories.fullmatch(relative_path) is not None)
+
+        # The scan doesn't look inside an ignored directory, so a negated pattern can't include what is below it
+        parts = relative_path.split('/')
+        for i in range(1, len(parts)):
+            if self._matches('/'.join(parts[:i]), True):
+                return True
+        return self._matches(relative_path, is_directory)
+
+    def _matches(self, relative_path: str, is_directory: bool) -> bool:
+        """check if the last rule that matches the path itself ignores it"""
+        ignored = False
+        for (expression, negated, directory_only) in self._rules:
+            if (not directory_only or is_directory) and expression.fullmatch(relative_path) is not None:
+                ignored = not negated
+        return ignored
+
+
+def _translate_pattern(pattern: str) -> str:
+    """translate a gitignore pattern to a regular expression for paths relative to the input directory"""
+    # Patterns with a slash are relative to the input directory, the others match at any depth
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            parts.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and (end := pattern.find(']', i + 2)) != -1:
+            characters = pattern[i + 1:end]
+            if characters[0] == '!':
+                characters = '^' + characters[1:]
+            parts.append('[' + characters.replace('\\', '\\\\') + ']')
+            i = end + 1
+        elif pattern[i] == '\\' and i + 1 < len(pattern):
+            parts.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    expression = "".join(parts)
+    return expression if anchored else '(?:.*/)?' + expression
+
+
+def _get_children_range(relative_path: str) -> tuple[str, str]:
+    """the paths below a directory sort between these two, so queries can use the index on the path.
+    '0' comes right after '/'"""
+    return (relative_path + '/', relative_path + '0')
+
+
+class FileIndex:
+    """persistent index of the size, mtime, inode and content hash of every file in the input directory.
+    The hash that was last sent to the server is stored as well so unchanged files don't have to be sent again"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # The index is used from the observer thread and the main thread
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime_ns INTEGER,
+            inode INTEGER,
+            hash TEXT,
+            sent_hash TEXT,
+            last_used REAL
+        )""")
+        self._connection.commit()
+        self._writes = 0
+        # Nested batches that are running, their writes aren't committed one by one
+        self._batches = 0
+        self._uncommitted = 0
+        self.prune()
+
+    @contextmanager
+    def batch(self):
+        """commit the writes made meanwhile together instead of one by one, like a sync that touches every file"""
+        with self._lock:
+            self._batches += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._batches -= 1
+                if self._batches == 0 and self._uncommitted:
+                    self._connection.commit()
+                    self._uncommitted = 0
+
+    def get_hash(self, relative_path: str, path: str, stat: os.stat_result = None) -> str:
+        """get the content hash of a file, only reading the file if its stat changed since it was last hashed.
+        `stat` can be given when the file was stat'ed already"""
+        if stat is None:
+            stat = os.stat(path)
+        with self._lock:
+            row = self._connection.execute("SELECT size, mtime_ns, inode, hash FROM files WHERE path = ?", (relative_path,)).fetchone()
+        if row is not None and row[:3] == (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            self._touch(relative_path)
+            return row[3]
+
+        digest = sync_shared.hash_file(path)
+        self._write("""INSERT INTO files (path, size, mtime_ns, inode, hash, last_used) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, inode = excluded.inode, hash = excluded.hash, last_used = excluded.last_used""",
+            (relative_path, stat.st_size, stat.st_mtime_ns, stat.st_ino, digest, time.time()))
+        return digest
+
+    def get_entry(self, relative_path: str) -> tuple | None:
+        """get the size, mtime, inode, hash and sent hash of a path"""
+        with self._lock:
+            return self._connection.execute("SELECT size, mtime_ns, inode, hash, sent_hash FROM files WHERE path = ?", (relative_path,)).fetchone()
+
+    def set_entries(self, rows: list):
+        """store the (path, size, mtime, inode, hash, sent hash) of many files in a single transaction"""
+        now = time.time()
+        with self._lock:
+            self._connection.executemany("""INSERT INTO files (path, size, mtime_ns, inode, hash, sent_hash, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, inode = excluded.inode, hash = excluded.hash,
+                    sent_hash = excluded.sent_hash, last_used = excluded.last_used""",
+                [(*row, now) for row in rows])
+            self._commit()
+
+    def is_sent(self, relative_path: str, digest: str) -> bool:
+        """check if the server already received these contents for the path"""
+        return self.get_sent(relative_path) == digest
+
+    def get_sent(self, relative_path: str) -> str | None:
+        """get the hash of the contents the server has for the path, the last version both sides agreed on"""
+        with self._lock:
+            row = self._connection.execute("SELECT sent_hash FROM files WHERE path = ?", (relative_path,)).fetchone()
+        return row[0] if row is not None else None
+
+    def has_sent(self, relative_path: str) -> bool:
+        """check if contents of the path or of anything below it were ever sent to the server"""
+        with self._lock:
+            row = self._connection.execute("SELECT 1 FROM files WHERE (path = ? OR (path >= ? AND path < ?)) AND sent_hash IS NOT NULL LIMIT 1",
+                (relative_path, *_get_children_range(relative_path))).fetchone()
+        return row is not None
+
+    def set_sent(self, relative_path: str, digest: str):
+        """remember the contents the server has for the path"""
+        self._write("""INSERT INTO files (path, sent_hash, last_used) VALUES (?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET sent_hash = excluded.sent_hash, last_used = excluded.last_used""",
+            (relative_path, digest, time.time()))
+
+    def forget(self, relative_path: str):
+        """remove a path and everything below it from the index"""
+        self._write("DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)", (relative_path, *_get_children_range(relative_path)))
+
+    def move(self, relative_source: str, relative_destination: str):
+        """move the entries of a path and everything below it to a new path"""
+        self.forget(relative_destination)
+        self._write("UPDATE files SET path = ? || substr(path, ?) WHERE path = ? OR (path >= ? AND path < ?)",
+            (relative_destination, len(relative_source) + 1, relative_source, *_get_children_range(relative_source)))
+
+    def prune(self):
+        """remove the least recently used paths when the index grows too large"""
+        self._write("""DELETE FROM files WHERE path IN (
+            SELECT path FROM files ORDER BY last_used DESC LIMIT -1 OFFSET ?
+        )""", (INDEX_MAX_ENTRIES,))
+
+    def _touch(self, relative_path: str):
+        self._write("UPDATE files SET last_used = ? WHERE path = ?", (time.time(), relative_path))
+
+    def _commit(self):
+        """commit the writes, unless a batch is running and it isn't time to commit yet. Called with the lock held"""
+        self._uncommitted += 1
+        if self._batches == 0 or self._uncommitted >= INDEX_COMMIT_INTERVAL:
+            self._connection.commit()
+            self._uncommitted = 0
+
+    def _write(self, query: str, parameters: tuple):
+        with self._lock:
+            self._connection.execute(query, parameters)
+            self._commit()
+            self._writes += 1
+            should_prune = self._writes % INDEX_PRUNE_INTERVAL == 0
+        if should_prune:
+            self.prune()
+
+
+class EventQueue:
+    """collects the watchdog events and coalesces them per path. A worker thread sends the result once no new events
+    arrived for the quiet period, so the observer thread never waits for the network. The changes are sent over their
+    own connection with interactive priority, so they don't wait behind a sync"""
+
+    def __init__(self, client: 'ClientSocket', quiet_period: float):
+        self.client = client
+        self.quiet_period = quiet_period
+        # Deletes and moves change the tree structure, so they are sent in the order they happened:
+        # [ACTION_DELETE, path] or [ACTION_MOVE, source, destination, is_directory]
+        self._operations = []
+        # Contents to send after the operations, relative path -> [action, whether the server doesn't have the path]
+        self._pending = {}
+        # Directories the server didn't have, moved in this batch as (source, destination). Their contents are
+        # already pending at the destination
+        self._created_moves = []
+        self._condition = Condition()
+        self._first_event = 0.0
+        self._last_event = 0.0
+        self._stopped = False
+        self.thread = Thread(target=self._run, daemon=True)
+        self.lane = None
+
+    def start(self):
+        self.lane = DataStream(self.client, 0)
+        self.thread.start()
+
+    def stop(self):
+        """send the remaining events and stop the worker"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self.thread.join()
+        self.lane.close()
+
+    def created(self, relative_path: str, is_directory: bool):
+        with self._condition:
+            entry = self._pending.get(relative_path)
+            new = entry is None or entry[1]
+            self._pending[relative_path] = [ACTION_DIRECTORY if is_directory else ACTION_UPLOAD, new]
+            self._notify()
+
+    def modified(self, relative_path: str):
+        with self._condition:
+            if relative_path not in self._pending:
+                self._pending[relative_path] = [ACTION_UPLOAD, False]
+            self._notify()
+
+    def deleted(self, relative_path: str, is_directory: bool):
+        with self._condition:
+            # Nothing below a deleted directory has to be sent anymore
+            if is_directory:
+                self._pop_children(relative_path)
+
+            entry = self._pending.pop(relative_path, None)
+            # Created and deleted in the same batch, the server never has to know
+            if entry is None or not entry[1]:
+                self._operations.append([ACTION_DELETE, relative_path])
+            self._notify()
+
+    def moved(self, relative_source: str, relative_destination: str, is_directory: bool):
+        with self._condition:
+            # watchdog also reports everything inside a moved directory, which is moved along already
+            for operation in self._operations:
+                if operation[0] == ACTION_MOVE and operation[3] and relative_source.startswith(operation[1] + '/') \
+                        and relative_destination == operation[2] + relative_source[len(operation[1]):]:
+                    self._notify()
+                    return
+            for (source, destination) in self._created_moves:
+                if relative_source.startswith(source + '/') \
+                        and relative_destination == destination + relative_source[len(source):]:
+                    self._notify()
+                    return
+
+            entry = self._pending.pop(relative_source, None)
+            children = self._pop_children(relative_source) if is_directory else {}
+            # Whatever was waiting for the destination is replaced
+            self._pending.pop(relative_destination, None)
+            if entry is None and self._has_new_parent(relative_source):
+                entry = [ACTION_DIRECTORY if is_directory else ACTION_UPLOAD, True]
+
+            if entry is not None and entry[1]:
+                # The server doesn't have the source, so it is simply created at the destination
+                self._pending[relative_destination] = [entry[0], False]
+                if is_directory:
+                    self._created_moves.append((relative_source, relative_destination))
+            else:
+                last = self._operations[-1] if self._operations else None
+                if last is not None and last[0] == ACTION_MOVE and last[2] == relative_source:
+                    # Collapse renames of the same path: a -> b -> c becomes a -> c
+                    last[2] = relative_destination
+                    if last[1] == last[2]:
+                        self._operations.pop()
+                else:
+                    self._operations.append([ACTION_MOVE, relative_source, relative_destination, is_directory])
+                if entry is not None:
+                    self._pending[relative_destination] = entry
+
+            for (path, child) in children.items():
+                self._pending[relative_destination + path[len(relative_source):]] = child
+            self._notify()
+
+    def _has_new_parent(self, relative_path: str) -> bool:
+        """whether the path is inside a directory the server doesn't have yet"""
+        # Unless it was moved there from a path the server has
+        for operation in self._operations:
+            if operation[0] == ACTION_MOVE and (relative_path + '/').startswith(operation[2] + '/'):
+                return False
+        while '/' in relative_path:
+            relative_path = relative_path.rsplit('/', 1)[0]
+            entry = self._pending.get(relative_path)
+            if entry is not None and entry[1]:
+                return True
+        return False
+
+    def _pop_children(self, relative_path: str) -> dict:
+        """remove and return the pending contents below a directory"""
+        prefix = relative_path + '/'
+        return {path: self._pending.pop(path) for path in [path for path in self._pending if path.startswith(prefix)]}
+
+    def _notify(self):
+        now = time.monotonic()
+        if not self._first_event:
+            self._first_event = now
+        self._last_event = now
+        sync_shared.metrics.set("sync_client_queue_depth", len(self._operations) + len(self._pending))
+        self._condition.notify()
+
+    def _run(self):
+        self.client._local.lane = self.lane
+        while True:
+            with self._condition:
+                while not self._pending and not self._operations and not self._stopped:
+                    self._condition.wait()
+                if not self._pending and not self._operations:
+                    return
+
+                # Wait until the directory is quiet, but don't hold events back forever
+                while not self._stopped:
+                    now = time.monotonic()
+                    remaining = min(self._last_event + self.quiet_period, self._first_event + MAX_EVENT_DELAY) - now
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                (operations, batch) = (self._operations, self._pending)
+                self._operations = []
+                self._pending = {}
+                self._created_moves = []
+                first_event = self._first_event
+                self._first_event = 0.0
+                sync_shared.metrics.set("sync_client_queue_depth", 0)
+
+            try:
+                with self.client.scheduler.interactive():
+                    self._send(operations, batch)
+            except Exception as e:
+                sync_shared.fail(f"Could not send {len(operations) + len(batch)} changes: {e}")
+                continue
+            sync_shared.metrics.observe("sync_client_event_latency_seconds", time.monotonic() - first_event)
+
+    def _send(self, operations: list, batch: dict):
+        """send a batch of coalesced events to the server"""
+        client = self.client
+        # Large batches like a branch checkout are cheaper as a single sync. It runs on the main thread with bulk
+        # priority, so the worker stays free for the next changes. A sync that runs already is followed by another one
+        if len(operations) + len(batch) > BATCH_SYNC_THRESHOLD:
+            sync_shared.info(f"{len(operations) + len(batch)} paths changed, syncing the file tree...")
+            client.sync_requested.set()
+            return
+
+        for operation in operations:
+            if operation[0] == ACTION_DELETE:
+                relative_path = operation[1]
+                sync_shared.info(f"Deleted '{relative_path}'")
+                client.index.forget(relative_path)
+                client.send_event(create_event_headers("deleted", source_path=os.path.join(client.input_directory, relative_path)))
+            else:
+                (_, relative_source, relative_destination, is_directory) = operation
+                sync_shared.info(f"Moved '{relative_source}' to '{relative_destination}'")
+                # The contents didn't change, so the index stays valid at the new path
+                client.index.move(relative_source, relative_destination)
+                client.send_event(create_event_headers(
+                    "moved",
+                    directory=is_directory,
+                    source_path=os.path.join(client.input_directory, relative_source),
+                    destination_path=os.path.join(client.input_directory, relative_destination)
+                ))
+
+        directories = sorted(path for (path, (action, _)) in batch.items() if action == ACTION_DIRECTORY)
+        uploads = [path for (path, (action, _)) in batch.items() if action == ACTION_UPLOAD]
+
+        def prune(_: str, entry: os.DirEntry) -> bool:
+            return client.is_skipped(entry.path, entry.is_dir())
+
+        (created, files) = ([], [])
+        # Paths found by scanning new directories
+        listed = set()
+        for relative_path in directories:
+            path = os.path.join(client.input_directory, relative_path)
+            # A directory comes after its parent, which scanned it already
+            if path in listed or not os.path.isdir(path):
+                continue
+            sync_shared.info(f"Created directory '{relative_path}'")
+            created.append(path)
+            # watchdog doesn't report everything inside a new directory, e.g. when it was moved in or renamed right
+            # after its contents were written, so the contents are scanned
+            for (_, entry) in sync_shared.scan_tree(path, prune, client.scan_workers):
+                listed.add(entry.path)
+                (created if entry.is_dir() else files).append(entry.path)
+
+        for relative_path in uploads:
+            path = os.path.join(client.input_directory, relative_path)
+            # The file can be gone again without an event for it, e.g. when its directory was deleted
+            if path not in listed and os.path.isfile(path):
+                files.append(path)
+        client._send_files(files, created)
+        client.flush()
+
 
 class MyHandler(FileSystemEventHandler):
-    # Store the previous modified event
-    prev_path = {
-        "path": '',
-        "time": 0
-    }
+    """forwards the watchdog events to the event queue"""
 
     def on_modified(self,  event):
         """on path modified"""
         # NOTE:
         # VSCode (and maybe other editors) send two file modified events, because they save them twice or write in buffers? idk
-        # So the file will be sent twice. It is possible to counter this but not worth enough to code a system that is responsive with the file size
-        # e.g. if a text file is over 40mb or so the VSCode will trigger a modified event 3 times so the 40mb file will be sent 3 times
-        # This loss could add up to huge delays but that is out of the scope of this project.
+        # Both events are coalesced by the event queue and the contents are compared with the last sent contents in `send_file`
 
-
-        # Don't send modified events when a directory changes or the previous modifed event of the same file was fires less than DUPLICATE_DELAY seconds ago
-        if (time.time() - self.prev_path["time"] < DUPLICATE_DELAY and self.prev_path["path"] == event.src_path) or event.is_directory == True:
+        # Don't send modified events when a directory changes
+        if event.is_directory == True or socket_handler.is_skipped(event.src_path, False):
             return
-        
-        socket_handler.send_file(event.src_path)
-        self.prev_path["time"] = time.time()
-        self.prev_path["path"] = event.src_path
-        
+
+        socket_handler.events.modified(socket_handler.get_relative_path(event.src_path))
+
     def on_created(self,  event):
         """on path created"""
-        relative_path = socket_handler.get_relative_path(event.src_path)
-        sync_shared.info(f"Created { 'directory' if event.is_directory else 'file' } '{relative_path}'")
-
-        socket_handler.send(create_event_headers(event.event_type, event.is_directory, event.src_path), "event")
+        if socket_handler.is_skipped(event.src_path, event.is_directory):
+            return
+        socket_handler.events.created(socket_handler.get_relative_path(event.src_path), event.is_directory)
 
     def on_deleted(self,  event):
         """on path deleted"""
-        relative_path = socket_handler.get_relative_path(event.src_path)
-        sync_shared.info(f"Deleted '{relative_path}'")
+        if socket_handler.is_skipped(event.src_path, event.is_directory):
+            return
+        socket_handler.events.deleted(socket_handler.get_relative_path(event.src_path), event.is_directory)
+
+    def on_moved(self, event):
+        """on path renamed or moved"""
+        # Moving a path out of the metadata directory or an ignored directory creates it, moving it in deletes it
+        if socket_handler.is_skipped(event.src_path, event.is_directory):
+            if not socket_handler.is_skipped(event.dest_path, event.is_directory):
+                socket_handler.events.created(socket_handler.get_relative_path(event.dest_path), event.is_directory)
+            return
+        if socket_handler.is_skipped(event.dest_path, event.is_directory):
+            socket_handler.events.deleted(socket_handler.get_relative_path(event.src_path), event.is_directory)
+            return
+        socket_handler.events.moved(socket_handler.get_relative_path(event.src_path), socket_handler.get_relative_path(event.dest_path), event.is_directory)
+
+
+class Operations:
+    """the operations sent over one connection that the server didn't acknowledge yet. At most `window` operations
+    are in flight, so sending doesn't wait for every acknowledgement but can't run too far ahead of the server either"""
+
+    def __init__(self, window: int):
+        self.window = window
+        self._condition = Condition()
+        # sequence number -> [retry, on_ack, description, attempts]
+        self._in_flight = {}
+        # sequence number -> time the operation was sent
+        self._sent_at = {}
+        # Operations the server couldn't apply and the error, the thread that sends over the connection sends them again
+        self._failed = []
+        self._next_seq = 1
+        self._closed = False
+
+    def add(self, operation: list) -> int:
+        """wait for room in the window and return the sequence number of the operation"""
+        with self._condition:
+            while len(self._in_flight) >= self.window and not self._closed:
+                self._condition.wait()
+            seq = self._next_seq
+            self._next_seq += 1
+            self._in_flight[seq] = operation
+            self._sent_at[seq] = time.monotonic()
+        sync_shared.metrics.inc("sync_client_operations_in_flight")
+        return seq
+
+    def acknowledge(self, ack: dict):
+        with self._condition:
+            operation = self._in_flight.pop(ack["seq"], None)
+            if operation is not None:
+                sync_shared.metrics.inc("sync_client_operations_in_flight", -1)
+                sync_shared.metrics.observe("sync_client_ack_latency_seconds", time.monotonic() - self._sent_at.pop(ack["seq"]))
+                if ack["ok"]:
+                    if operation[1] is not None:
+                        operation[1]()
+                else:
+                    self._failed.append((operation, ack.get("error")))
+            self._condition.notify_all()
+
+    def take_failed(self) -> list:
+        with self._condition:
+            (failed, self._failed) = (self._failed, [])
+            return failed
+
+    def wait(self):
+        """wait until every operation is acknowledged"""
+        with self._condition:
+            while self._in_flight and not self._closed:
+                self._condition.wait()
+
+    def close(self):
+        """stop waiting for acknowledgements, the connection is gone"""
+        with self._condition:
+            self._closed = True
+            # These won't be acknowledged anymore
+            sync_shared.metrics.inc("sync_client_operations_in_flight", -len(self._in_flight))
+            self._in_flight.clear()
+            self._sent_at.clear()
+            self._condition.notify_all()
+
+
+class TokenBucket:
+    """limits the bytes per second of a priority, a burst of at most one second of data is allowed after a quiet moment.
+    Without a rate nothing is limited"""
+
+    def __init__(self, rate: int | None):
+        self.rate = rate
+        self._lock = Lock()
+        self._tokens = rate or 0
+        self._last = time.monotonic()
+
+    def take(self, amount: int) -> float:
+        """wait until `amount` bytes can be sent and return the seconds it waited"""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # A piece goes into debt and waits until it's paid off, so pieces larger than the burst still get through
+            self._tokens -= amount
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+class Scheduler:
+    """decides which data goes over the wire first. Changes caught by the watcher are interactive and are sent over
+    their own connection, the transfers of a sync are bulk. Bulk transfers are sent in chunks and wait between chunks
+    while interactive changes are being sent, so a saved file doesn't wait for a large file of the sync.
+    Every priority can have a bandwidth limit"""
+
+    def __init__(self, bulk_limit: int | None, interactive_limit: int | None):
+        self._buckets = {PRIORITY_BULK: TokenBucket(bulk_limit), PRIORITY_INTERACTIVE: TokenBucket(interactive_limit)}
+        self._condition = Condition()
+        # Batches of interactive changes that are being sent
+        self._active = 0
+        # relative path -> [version of the newest transfer, amount of transfers of the path]
+        self._transfers = {}
+        self._next_version = 1
+        # The priority of the current thread
+        self._local = local()
+
+    @property
+    def priority(self) -> str:
+        return getattr(self._local, "priority", PRIORITY_BULK)
+
+    @contextmanager
+    def use(self, priority: str):
+        """send everything of the current thread with `priority`"""
+        previous = self.priority
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    @contextmanager
+    def interactive(self):
+        """send interactive changes, bulk transfers wait until they are sent"""
+        with self._condition:
+            self._active += 1
+        try:
+            with self.use(PRIORITY_INTERACTIVE):
+                yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    @contextmanager
+    def transfer(self, relative_path: str):
+        """register a transfer of a file and get its version. Starting a newer transfer of the same file supersedes it"""
+        with self._condition:
+            version = self._next_version
+            self._next_version += 1
+            entry = self._transfers.setdefault(relative_path, [0, 0])
+            entry[0] = version
+            entry[1] += 1
+            # An older bulk transfer of the file doesn't have to wait anymore, the server throws it away
+            self._condition.notify_all()
+        try:
+            yield version
+        finally:
+            with self._condition:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._transfers[relative_path]
+
+    def is_superseded(self, relative_path: str, version: int) -> bool:
+        with self._condition:
+            entry = self._transfers.get(relative_path)
+            return entry is not None and entry[0] != version
+
+    def throttle(self, amount: int, relative_path: str = None, version: int = None):
+        """wait until the next `amount` bytes of the current thread can be sent"""
+        priority = self.priority
+        if priority == PRIORITY_BULK and self._active:
+            start = time.monotonic()
+            deadline = start + MAX_PREEMPTION
+            with self._condition:
+                # A superseded transfer can't wait, an interactive transfer of the same file may wait for it on the server
+                while self._active and (relative_path is None or self._transfers[relative_path][0] == version):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            sync_shared.metrics.inc("sync_client_preempted_seconds_total", time.monotonic() - start)
+        delay = self._buckets[priority].take(amount)
+        if delay:
+            sync_shared.metrics.inc("sync_client_throttled_seconds_total", delay, priority=priority)
+
+    def pacer(self, relative_path: str = None, version: int = None):
+        """get the throttle for the chunks of a transfer"""
+        return lambda amount: self.throttle(amount, relative_path, version)
+
+
+class DataStream:
+    """an extra connection to the server that only sends files, so files can be sent in parallel during the initial sync.
+    The interactive changes are sent over a data stream as well, which can also wait for replies of the server"""
+
+    def __init__(self, client: 'ClientSocket', number: int):
+        self.client = client
+        self.number = number
+        # Replies to requests sent over this connection
+        self.replies = Queue()
+        self.request_lock = Lock()
+        # Why sending over the stream failed, the thread that fills the queue stops the client
+        self.error = None
+        # Statistics to report the throughput of the stream
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+        try:
+            self._socket = socket.create_connection((client.server_ip, client.port))
+            self._receiver = sync_shared.Receiver(self._socket, client.buffer_size)
+            # The changes of the server are only pushed over the main connection, but the server still checks the
+            # files sent here for conflicts by the hash the client last agreed on
+            client._handshake(self._socket, self._receiver)
+        except socket.error as msg:
+            sync_shared.fail("Could not open a data stream to the server.")
+            sync_shared.fail(msg)
+            sys.exit(1)
+
+        self.operations = Operations(OPERATION_WINDOW)
+        client.operations[self._socket] = self.operations
+        # The server acknowledges the files over the same connection
+        self.incoming_thread = Thread(target=self._handle_acks, daemon=True)
+        self.incoming_thread.start()
+
+    def _handle_acks(self):
+        while True:
+            try:
+                (content_type, _, payload) = sync_shared.receive_frame(self._receiver)
+            except (OSError, ValueError):
+                break
+            if content_type == "ack":
+                self.operations.acknowledge(sync_shared.decode_fields(payload))
+            elif content_type in ("manifest", "signature"):
+                self.replies.put(json.loads(payload))
+            elif content_type == "reply":
+                self.replies.put(sync_shared.decode_fields(payload))
+            elif payload == sync_shared.DISCONNECT_MESSAGE.encode(sync_shared.FORMAT):
+                break
+        self.operations.close()
+
+    def run(self, queue: Queue, progress: sync_shared.ProgressView, priority: str, failed: Event):
+        """send the files in the queue until None is received, with the priority of the thread that queued them.
+        When sending fails `failed` is set and the rest of the queue is skipped, so the thread that fills it never waits"""
+        with self.client.scheduler.use(priority):
+            while (path := queue.get()) is not None:
+                if failed.is_set():
+                    continue
+                start = time.perf_counter()
+                try:
+                    self.bytes += self.client.send_file(path, self._socket, show_progress=False)
+                # Exiting only stops this thread, so a broken connection is reported to the thread that fills the queue
+                except (Exception, SystemExit) as e:
+                    self.error = e
+                    failed.set()
+                    continue
+                self.seconds += time.perf_counter() - start
+                self.files += 1
+                progress.advance(1)
+
+    def close(self):
+        self.client.flush(self._socket)
+        del self.client.operations[self._socket]
+        sync_shared.send(self._socket, sync_shared.DISCONNECT_MESSAGE)
+        self.incoming_thread.join()
+        self._socket.close()
+        self._receiver.close()
+
+
+def _get_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def _get_entry_size(entry: os.DirEntry) -> int:
+    try:
+        return entry.stat().st_size
+    except OSError:
+        return 0
+
+
+class FileSnapshot:
+    """a file that is opened to be sent and its size, modification time and inode at that moment.
+    Files can change while they are read, so the sender checks `changed` after the contents are sent. Without a
+    reflink copy the contents are read from the opened file in bounded pieces, a file that got shorter is padded
+    with zeros and the transfer turns out stale"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.f = open(path, 'rb')
+        self.stat = os.fstat(self.f.fileno())
+        # Path of the reflink copy the contents are read from, if one was made
+        self.copy_path = None
+
+    def __enter__(self) -> 'FileSnapshot':
+        return self
+
+    def __exit__(self, *_):
+        self.f.close()
+        if self.copy_path is not None:
+            os.remove(self.copy_path)
+
+    def freeze(self, directory: str) -> bool:
+        """read the contents from a reflink copy in `directory` from now on, which can't change anymore.
+        Returns False if the filesystem doesn't support reflinks"""
+        os.makedirs(directory, exist_ok=True)
+        (fd, copy_path) = tempfile.mkstemp(dir=directory)
+        copy = os.fdopen(fd, 'r+b')
+        if not sync_shared.reflink(self.f, copy):
+            copy.close()
+            os.remove(copy_path)
+            return False
+        # The copy only has the contents of the opened file if it didn't change in the meantime,
+        # otherwise the original stays open and the transfer is stale anyway
+        if self.changed():
+            copy.close()
+            os.remove(copy_path)
+            return True
+        self.f.close()
+        (self.f, self.copy_path) = (copy, copy_path)
+        sync_shared.metrics.inc("sync_client_snapshots_total")
+        return True
+
+    def changed(self) -> bool:
+        """check if the file changed or was replaced since it was opened. A frozen file never changes"""
+        if self.copy_path is not None:
+            return False
+        stat = os.fstat(self.f.fileno())
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return True
+        return (stat.st_size, stat.st_mtime_ns, inode) != (self.stat.st_size, self.stat.st_mtime_ns, self.stat.st_ino)
 
-        socket_handler.send(create_event_headers(event.event_type, event.is_directory, event.src_path), "event")
 
 # TODO: write class strings and file docstring
 class ClientSocket:
     connected = False
 
     def __init__(self):
+        # Replies from the server to requests like "manifest" are handed over from the incoming thread
+        self.replies = Queue()
+        # Only one request can wait for a reply at the same time
+        self.request_lock = Lock()
+        # Bytes before and after compressing and the cpu time it took, reported after each batch of files
+        self.compression_stats = [0, 0, 0.0]
+        self.compression_lock = Lock()
+        # Operations that wait for an acknowledgement, per connection
+        self.operations = {}
+        # The data stream the current thread sends over instead of the main connection
+        self._local = local()
+        self.syncing = False
+        # Set when changes are too many to send one by one, the main thread syncs the tree then
+        self.sync_requested = Event()
         self._parse_args()
+        self.scheduler = Scheduler(self.bulk_limit, self.interactive_limit)
+        self.index = FileIndex(os.path.join(self.input_directory, sync_shared.METADATA_DIRECTORY, INDEX_NAME))
+        # Snapshots left behind by a client that didn't stop cleanly
+        rmtree(self.snapshot_directory, ignore_errors=True)
+        self.events = EventQueue(self, self.quiet_period)
         sync_shared.info("Logging from CLIENT side")
+        if self.metrics_port is not None:
+            sync_shared.serve_metrics("localhost", self.metrics_port)
         self._connect()
 
-    def send(self, message: str, content_type="message"):
+    def send(self, message: str | dict, content_type="message"):
         sync_shared.send(self._socket, message, content_type)
 
-    def send_file(self, path: str):
-        """send a file to the server"""
+    def _get_stream(self, stream: socket.socket | None) -> socket.socket:
+        """the connection to send over when no connection is given"""
+        if stream is not None:
+            return stream
+        lane = getattr(self._local, "lane", None)
+        return self._socket if lane is None else lane._socket
 
-        relative_path = self.get_relative_path(path)
+    def send_event(self, event_headers: dict, stream: socket.socket = None, on_ack=None, attempts=0, retry=None):
+        """send an event that changes the output directory, over `stream` if given.
+        `retry` sends the change again in another way if the server couldn't apply the event"""
+        stream = self._get_stream(stream)
+        if retry is None:
+            retry = lambda attempts: self.send_event(event_headers, stream, on_ack, attempts)
+        seq = self._begin_operation(stream, [retry, on_ack, f"{event_headers['event-type']} event", attempts])
+        sync_shared.send(stream, {**event_headers, "seq": seq}, "event")
 
-        # give the filesystem some time to reload
-        time.sleep(0.2)
-        size = os.path.getsize(path)
-        count = 0
-        # make sure over 50KB files are always checked twice for size.
-        prev_size = size if size < 50000 else 0
-        while count < 10 and size != prev_size:
-            # Vscode fires 2 modified events and is sometimes a little slow, because of that size will be 0
-            # So this code cheks up to five times if os.path.getsize yields the same result when run twice
-            time.sleep(0.2)
-            prev_size = size
-            size = os.path.getsize(path)
-            count += 1
-        # Send a 'clear' event when the file size is 0
-        if size == 0:
-            self.send(create_event_headers("clear", path), "event")
-            return
-        if count == 10 or size != prev_size:
-            sync_shared.fail(f"Could not send {relative_path}. File is too large!")
-            return
+    def _begin_operation(self, stream: socket.socket, operation: list) -> int:
+        """get the sequence number for the next operation over a connection"""
+        self._retry_failed(stream)
+        return self.operations[stream].add(operation)
 
-        # Show progress bar
+    def _retry_failed(self, stream: socket.socket) -> bool:
+        """send the operations the server couldn't apply again. Returns if there were any"""
+        failed = self.operations[stream].take_failed()
+        for ((retry, _, description, attempts), error) in failed:
+            if attempts >= MAX_RETRIES:
+                sync_shared.fail(f"The server could not apply {description}: {error}")
+                continue
+            sync_shared.warn(f"Sending {description} again, the server could not apply it: {error}")
+            sync_shared.metrics.inc("sync_client_retransmits_total")
+            retry(attempts + 1)
+        return bool(failed)
+
+    def flush(self, stream: socket.socket = None):
+        """wait until the server acknowledged every operation sent over a connection"""
+        stream = self._get_stream(stream)
+        while True:
+            self.operations[stream].wait()
+            if not self._retry_failed(stream):
+                break
+
+    def send_file(self, path: str, stream: socket.socket = None, show_progress=True, attempts=0, stale=0) -> int:
+        """send a file to the server, over `stream` if given. Returns the amount of bytes that were sent.
+        A file that changes while it is sent is sent again, `stale` counts how often that happened already"""
+        stream = self._get_stream(stream)
+
+        relative_path = self.get_relative_path(path)
         try:
-            # Send header
-            # The end string length is added to the size
-            file_header = {
-                "file-length": size,
-                "path": relative_path
-            }
-            file_header = json.dumps(file_header)
-            self.send(file_header, "file")
-            
+            snapshot = FileSnapshot(path)
+        # Deleted after it was found, the delete is sent by the watcher
+        except FileNotFoundError:
+            return 0
+        with snapshot, self.scheduler.transfer(relative_path) as version:
+            size = snapshot.stat.st_size
+            # Skip files of which the server already has the same contents
+            digest = self.index.get_hash(relative_path, path)
+            if self.index.is_sent(relative_path, digest):
+                return 0
+
+            # The index only remembers the contents once the server wrote them
+            on_ack = lambda: self.index.set_sent(relative_path, digest)
+            retry = lambda attempts: self.send_file(path, stream, show_progress, attempts)
+            operation = [retry, on_ack, f"'{relative_path}'", attempts]
+
+            # Send a 'clear' event when the file size is 0
+            if size == 0:
+                self.send_event(create_event_headers("clear", source_path=path), stream, on_ack, attempts)
+                return 0
+
+            # Large files that are still being written are read from a copy that doesn't change, where that's free
+            if self.snapshots and size >= SNAPSHOT_MIN_SIZE and not snapshot.freeze(self.snapshot_directory):
+                sync_shared.info("The filesystem of the input directory doesn't support reflinks, files are sent without snapshots")
+                self.snapshots = False
+
+            throttle = self.scheduler.pacer(relative_path, version)
+            try:
+                # Only send the changed blocks of large files the server already has. A retry after the server couldn't
+                # apply the file sends all of it
+                sent = self.send_delta(snapshot, stream, operation, throttle) if size >= sync_shared.DELTA_THRESHOLD and not attempts else None
+                if sent is None:
+                    sent = self._send_contents_of(snapshot, stream, operation, digest, show_progress, throttle)
+                superseded = self.scheduler.is_superseded(relative_path, version)
+                changed = self._send_trailer(stream, snapshot, operation, superseded)
+            except socket.error as msg:
+                sync_shared.fail(f"Could not send file {path}")
+                sync_shared.fail(msg)
+                sys.exit(1)
+
+        if not changed:
+            return sent
+        if superseded:
+            # The newer transfer reads the file again, so this one doesn't have to be repeated
+            sync_shared.info(f"'{relative_path}' was sent again while it was sent, the server keeps the newer transfer")
+            sync_shared.metrics.inc("sync_client_superseded_transfers_total")
+            return sent
+        sync_shared.metrics.inc("sync_client_stale_transfers_total")
+        if stale >= STALE_RETRIES:
+            # Queued like a change of the watcher, so it's sent after the next quiet period instead of read over and over
+            sync_shared.warn(f"'{relative_path}' keeps changing while it is sent, it is sent again when it stops changing")
+            self.events.modified(relative_path)
+            return sent
+        sync_shared.info(f"'{relative_path}' changed while it was sent, sending it again")
+        return sent + self.send_file(path, stream, show_progress, attempts, stale + 1)
+
+    def _send_contents_of(self, snapshot: FileSnapshot, stream: socket.socket, operation: list, digest: str, show_progress: bool, throttle=None) -> int:
+        """send the whole file, or the rest of a transfer that broke off. Returns the amount of bytes that were sent"""
+        relative_path = self.get_relative_path(snapshot.path)
+        (size, mtime) = (snapshot.stat.st_size, snapshot.stat.st_mtime_ns)
+        file_header = {
+            "file-length": size,
+            "mtime": mtime,
+            "path": relative_path,
+            # The trailer after the contents tells if the file changed while it was read
+            "trailer": True,
+            **self._version_headers(relative_path, digest)
+        }
+
+        # Large files continue where a broken off transfer stopped
+        offset = self._get_resume_offset(snapshot) if size > sync_shared.RESUME_CHECKPOINT else 0
+        if offset:
+            file_header["offset"] = offset
+            sync_shared.info(f"Continuing '{relative_path}' at {sync_shared.format_size(offset)}")
+
+        f = snapshot.f
+        # Files that are compressed already are sent as they are, so the kernel can still copy them
+        codec = self.codec if self.codec is not None and sync_shared.is_compressible(snapshot.path, f) else None
+        if codec is not None:
+            file_header["compression"] = codec
+        file_header["seq"] = self._begin_operation(stream, operation)
+        sync_shared.send(stream, file_header, "file")
+
+        if show_progress and size - offset >= sync_shared.PROGRESS_MIN_SIZE:
             # Pretty progress bar :)
-            with rich.progress.Progress(
-                rich.progress.TextColumn("{task.description}"),
-                rich.progress.BarColumn(),
-                rich.progress.FileSizeColumn(),
-                rich.progress.TotalFileSizeColumn(),
-                rich.progress.TimeRemainingColumn()
-            ) as progress:
-                read_task = progress.add_task(f"Reading {relative_path}...", total=size)
-                with open(path, 'rb') as f:
-                    while True:
-                        # read the file and send it in segments of the MTU
-                        bytes_read = f.read(sync_shared.MTU)
-                        if not bytes_read:
-                            break
-                        # Send the bytes and update the progress bar
-                        progress.update(read_task, advance=len(bytes_read))
-                        self._socket.sendall(bytes_read)
-                
-        except socket.error as msg:
-            sync_shared.fail(f"Could not send file {path}")
-            sync_shared.fail(msg)
-            sys.exit(1)
+            with sync_shared.ProgressView(f"Reading {relative_path}...", size, offset) as progress:
+                # Let the kernel copy the file to the socket and update the progress bar in between
+                (_, wire_size) = self._send_contents(stream, f, offset, size, codec, progress.advance, throttle)
+        else:
+            (_, wire_size) = self._send_contents(stream, f, offset, size, codec, throttle=throttle)
+        if codec is not None and show_progress:
+            sync_shared.info(f"Sent '{relative_path}' as {sync_shared.format_size(wire_size)} ({wire_size / (size - offset):.0%} of {sync_shared.format_size(size - offset)})")
+        sync_shared.metrics.inc("sync_client_bytes_sent_total", wire_size, kind="file")
+        sync_shared.metrics.inc("sync_client_files_sent_total", kind="file")
+        return size - offset
+
+    def _send_trailer(self, stream: socket.socket, snapshot: FileSnapshot, operation: list, superseded=False) -> bool:
+        """tell the server if the file changed while its contents were sent, the server throws stale contents away.
+        A transfer is stale as well when a newer transfer of the file started meanwhile. Returns if the transfer is stale"""
+        stale = superseded or snapshot.changed()
+        if stale:
+            # The hash doesn't describe what was sent, the server acknowledges without writing anything
+            operation[1] = None
+        sync_shared.send(stream, {"stale": stale}, "trailer")
+        return stale
+
+    def _version_headers(self, relative_path: str, digest: str) -> dict:
+        """the hash of the contents that are sent, so the server can find them for other files with the same contents.
+        A bidirectional server also gets the hash of the contents it had when both sides last agreed, to tell if the
+        file changed on its side in the meantime"""
+        if not self.bidirectional:
+            return {"hash": digest}
+        return {"hash": digest, "base": self.index.get_sent(relative_path)}
+
+    def _get_resume_offset(self, snapshot: FileSnapshot) -> int:
+        """ask the server how much of a file it kept from a broken off transfer and check that this part didn't change"""
+        event_headers = create_event_headers("resume", source_path=snapshot.path)
+        event_headers["file-length"] = snapshot.stat.st_size
+        event_headers["mtime"] = snapshot.stat.st_mtime_ns
+        reply = self.request(event_headers)
+
+        offset = reply.get("offset", 0)
+        if offset and sync_shared.prefix_hash(snapshot.f, offset) != reply["hash"]:
+            return 0
+        return offset
+
+    def _send_contents(self, stream: socket.socket, f, start: int, size: int, codec: str | None, on_progress=None, throttle=None) -> tuple[int, int]:
+        """send the contents of a file from `start` on, compressed with `codec` if given. Returns the amount of bytes read and sent"""
+        if codec is None:
+            sent = sync_shared.send_file_contents(stream, f, size - start, on_progress, start, throttle, self.use_sendfile)
+            return (sent, size - start)
+
+        f.seek(start)
+        (sent, wire_size, cpu_time) = sync_shared.send_compressed_contents(stream, f, size - start, codec, on_progress, throttle)
+        with self.compression_lock:
+            self.compression_stats[0] += size - start
+            self.compression_stats[1] += wire_size
+            self.compression_stats[2] += cpu_time
+        return (sent, wire_size)
+
+    def report_compression(self):
+        """log how well the files sent since the last report compressed"""
+        with self.compression_lock:
+            (size, wire_size, cpu_time) = self.compression_stats
+            self.compression_stats = [0, 0, 0.0]
+        if size:
+            sync_shared.info(f"Compressed {sync_shared.format_size(size)} to {sync_shared.format_size(wire_size)} ({wire_size / size:.0%}) with {self.codec} in {cpu_time:.2f}s of cpu time")
+
+    def send_delta(self, snapshot: FileSnapshot, stream: socket.socket, operation: list, throttle=None) -> int | None:
+        """send only the difference between an opened file and the copy on the server, followed by a trailer.
+        Returns the amount of bytes that were sent or None if the whole file should be sent instead"""
+        path = snapshot.path
+        relative_path = self.get_relative_path(path)
+        signature = self.request(create_event_headers("signature", source_path=path))
+        if not signature["blocks"]:
+            return None
+
+        stat = snapshot.stat
+        instructions = sync_shared.compute_delta(snapshot.f, stat.st_size, signature)
+        # Not worth it if (almost) nothing of the old file can be reused
+        if instructions is None:
+            return None
+        length = sync_shared.delta_length(instructions)
+        if length >= stat.st_size * 0.9:
+            return None
+
+        delta_header = {
+            "file-length": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "path": relative_path,
+            "block-size": signature["block-size"],
+            "delta-length": length,
+            "trailer": True,
+            **self._version_headers(relative_path, self.index.get_hash(relative_path, path))
+        }
+        if throttle is not None:
+            throttle(length)
+        delta_header["seq"] = self._begin_operation(stream, operation)
+        sync_shared.send(stream, delta_header, "delta")
+        sync_shared.send_delta(stream, snapshot.f, instructions)
+
+        sync_shared.done(f"Sent delta of '{relative_path}': {length} of {stat.st_size} bytes")
+        sync_shared.metrics.inc("sync_client_bytes_sent_total", length, kind="delta")
+        sync_shared.metrics.inc("sync_client_files_sent_total", kind="delta")
+        return length
+
+    def is_metadata(self, path: str) -> bool:
+        """check if a path belongs to the metadata directory of the client"""
+        relative_path = self.get_relative_path(path)
+        return relative_path == sync_shared.METADATA_DIRECTORY or relative_path.startswith(sync_shared.METADATA_DIRECTORY + '/')
+
+    def is_skipped(self, path: str, is_directory: bool) -> bool:
+        """check if the watchdog event of a path should be skipped, because it's metadata or ignored"""
+        if self.is_metadata(path):
+            return True
+        relative_path = self.get_relative_path(path)
+        if relative_path in self.ignore_files:
+            ignore = self._load_ignore_rules()
+            if ignore.rules != self.ignore.rules:
+                self.ignore = ignore
+                sync_shared.info(f"Reloaded the ignore rules from '{relative_path}'")
+        if self.ignore and self.ignore.is_ignored(relative_path, is_directory):
+            sync_shared.metrics.inc("sync_client_ignored_events_total")
+            return True
+        return False
+
+    def _load_ignore_rules(self) -> IgnoreRules:
+        return IgnoreRules.load([os.path.join(self.input_directory, path) for path in self.ignore_files], self.ignore_patterns)
 
     def get_relative_path(self, path: str):
         """get the relative path from the input directory"""
@@ -148,25 +1229,328 @@ class ClientSocket:
         return relative_path
 
     def sync(self):
-        """Sync the current filetree with the server"""
+        """Sync the current filetree with the server by only sending the difference.
+        The differences are sent in batches while the rest of the tree is still scanned"""
         self.syncing = True
-        socket_handler.send(create_event_headers("sync"), "event")
+        remote = self.request_manifest()
+        sync_shared.info(f"Server has {len(remote)} paths, comparing with local tree...")
+
+        # Ignored paths and the size of the ignored files, counted by the threads of the scan
+        ignored = [0, 0]
+        ignored_lock = Lock()
+
+        def prune(relative_path: str, entry: os.DirEntry) -> bool:
+            # Don't send the index and other metadata of the client
+            if relative_path == sync_shared.METADATA_DIRECTORY:
+                return True
+            if not self.ignore:
+                return False
+            # Ignored directories are pruned so nothing below them is scanned
+            is_directory = entry.is_dir()
+            if not self.ignore.is_ignored(relative_path, is_directory):
+                return False
+            size = 0 if is_directory else _get_entry_size(entry)
+            with ignored_lock:
+                ignored[0] += 1
+                ignored[1] += size
+            return True
+
+        # Compare every file and directory with the manifest and collect everything the server is missing
+        local = set()
+        deleted, created, changed = [], [], []
+        # Paths that only changed on the server, when changes of the server are received
+        pulled, removed = [], []
+        # Totals of the batches that are sent already
+        (sent, made, deletes) = (0, 0, 0)
+        start = batch_start = time.perf_counter()
+        # Checking unchanged files updates the index for every file, which is committed in batches
+        with self.index.batch():
+            for (relative_path, entry) in sync_shared.scan_tree(self.input_directory, prune, self.scan_workers):
+                local.add(relative_path)
+                path = entry.path
+                remote_entry = remote.get(relative_path)
+                if entry.is_dir():
+                    if remote_entry is None or not remote_entry["directory"]:
+                        if remote_entry is not None:
+                            deleted.append(relative_path)
+                        created.append(path)
+                else:
+                    stat = entry.stat()
+                    if remote_entry is not None and remote_entry["directory"]:
+                        deleted.append(relative_path)
+                        remote_entry = None
+                    if remote_entry is None or self._has_changed(relative_path, path, stat, remote_entry):
+                        if self.bidirectional and self._is_unchanged(relative_path, path, stat):
+                            # The local file is still the version both sides agreed on, so the server changed or deleted it
+                            (pulled if remote_entry is not None else removed).append(relative_path)
+                        else:
+                            changed.append(path)
 
-        # Walk over all files and directories and recreate the filetree at server side
-        for root, dirs, files in os.walk(self.input_directory):
-            for name in dirs:
-                path = os.path.join(root, name)
+                # Start sending while the scan goes on, a directory is scanned before its contents so it's always sent first
+                if len(changed) + len(created) >= SYNC_BATCH_SIZE or ((changed or created) and time.perf_counter() - batch_start >= SYNC_BATCH_DELAY):
+                    self._send_sync_batch(deleted, changed, created)
+                    (sent, made, deletes) = (sent + len(changed), made + len(created), deletes + len(deleted))
+                    deleted, created, changed = [], [], []
+                    batch_start = time.perf_counter()
 
-                socket_handler.send(create_event_headers("created", directory=True, source_path=path), "event")
-            for name in files:
-                path = os.path.join(root, name)
+        seconds = time.perf_counter() - start
+        sync_shared.info(f"Scanned {len(local)} paths in {seconds:.2f}s ({len(local) / max(seconds, 1e-6):.0f} paths/s)")
+        sync_shared.metrics.inc("sync_client_scanned_paths_total", len(local))
+        if ignored[0]:
+            sync_shared.info(f"Ignored {ignored[0]} paths ({sync_shared.format_size(ignored[1])})")
+            sync_shared.metrics.inc("sync_client_ignored_paths_total", ignored[0])
+            sync_shared.metrics.inc("sync_client_ignored_bytes_total", ignored[1])
 
-                socket_handler.send(create_event_headers("created", directory=False, source_path=path), "event")
-                socket_handler.send_file(path)
+        # Only delete the top most stale paths, the server removes directories recursively.
+        # Ignored paths on the server are left alone
+        (stale, stale_deleted) = ([], [])
+        for path in sorted(path for path in remote if path not in local and not (self.ignore and self.ignore.is_ignored(path, remote[path]["directory"]))):
+            if not stale or not path.startswith(stale[-1] + '/'):
+                stale.append(path)
+        for relative_path in stale:
+            # Paths that were never sent are new on the server
+            if self.bidirectional and not self.index.has_sent(relative_path):
+                pulled.append(relative_path)
+            else:
+                stale_deleted.append(relative_path)
+
+        for relative_path in removed:
+            sync_shared.info(f"Deleting '{relative_path}', it was deleted on the server")
+            os.remove(os.path.join(self.input_directory, relative_path))
+            self.index.forget(relative_path)
+        self._send_sync_batch(deleted, changed, created)
+        (sent, made, deletes) = (sent + len(changed), made + len(created), deletes + len(deleted) + len(stale_deleted))
+        # Stale paths go last, so files that moved while the client wasn't running can be made from them on the server
+        for relative_path in stale_deleted:
+            # Created again after it was scanned, the watcher sent it already
+            if os.path.lexists(os.path.join(self.input_directory, relative_path)):
+                continue
+            self.send_event(create_event_headers("deleted", source_path=os.path.join(self.input_directory, relative_path)))
+        # The server sends the pulled paths before it acknowledges the request
+        for relative_path in pulled:
+            self.send_event(create_event_headers("pull", source_path=os.path.join(self.input_directory, relative_path)))
+        self.flush()
 
-        sync_shared.done("Syncing is done")
+        sync_shared.done(f"Syncing is done: {sent} files sent, {made} directories created, {deletes} paths deleted" +
+            (f", {len(pulled)} paths received and {len(removed)} deleted from the server" if self.bidirectional else ""))
         self.syncing = False
 
+    def _send_sync_batch(self, deleted: list, changed: list, created: list):
+        """send the differences a sync found so far"""
+        # Paths that changed between a file and a directory go first, so the new ones can be made
+        for relative_path in deleted:
+            self.send_event(create_event_headers("deleted", source_path=os.path.join(self.input_directory, relative_path)))
+        if not self.bidirectional:
+            for path in changed:
+                # The server doesn't have these contents, whatever the index says
+                self.index.forget(self.get_relative_path(path))
+        self._send_files(changed, created)
+
+    def _send_files(self, paths: list, directories: list = ()):
+        """create the directories and send the files, small files in bundles and the others over multiple streams at the same time"""
+        paths = self._send_bundles(paths, directories)
+        paths = self._send_links(paths)
+        if len(paths) < STREAM_MIN_FILES:
+            for path in paths:
+                self.send_file(path)
+            return
+
+        # Many files get one progress view for all of them instead of a bar per file
+        with sync_shared.ProgressView(f"Sending {len(paths)} files...", len(paths), unit="files") as progress:
+            if self.streams <= 1:
+                for path in paths:
+                    self.send_file(path, show_progress=False)
+                    progress.advance(1)
+                return
+
+            # The deletes and directories sent before have to exist before files arrive over the other streams
+            self.request(create_event_headers("barrier"))
+
+            queue = Queue(maxsize=STREAM_QUEUE_SIZE)
+            failed = Event()
+            streams = [DataStream(self, number) for number in range(min(self.streams, len(paths)))]
+            threads = [Thread(target=stream.run, args=(queue, progress, self.scheduler.priority, failed)) for stream in streams]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+
+            # The queue is bounded so the walk doesn't get too far ahead of the streams
+            for path in paths:
+                if failed.is_set():
+                    break
+                queue.put(path)
+            for _ in streams:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+            seconds = time.perf_counter() - start
+
+        if failed.is_set():
+            for stream in streams:
+                # Exits were logged with their reason already
+                if stream.error is not None and not isinstance(stream.error, SystemExit):
+                    sync_shared.fail(f"Stream {stream.number} could not send files: {stream.error}")
+            sync_shared.fail("Lost the connection to the server while sending files.")
+            sys.exit(1)
+
+        total = 0
+        for stream in streams:
+            stream.close()
+            total += stream.bytes
+            sync_shared.info(f"Stream {stream.number}: {stream.files} files, {sync_shared.format_size(stream.bytes)} in {stream.seconds:.2f}s ({sync_shared.format_size(stream.bytes / max(stream.seconds, 1e-9))}/s)")
+        sync_shared.info(f"Sent {sync_shared.format_size(total)} over {len(streams)} streams in {seconds:.2f}s ({sync_shared.format_size(total / max(seconds, 1e-9))}/s)")
+        self.report_compression()
+
+    def _send_links(self, paths: list) -> list:
+        """let the server make the files of which it has the contents somewhere already, instead of sending them.
+        Returns the files that have to be sent"""
+        hashes = {}
+        for path in paths:
+            relative_path = self.get_relative_path(path)
+            try:
+                digest = self.index.get_hash(relative_path, path)
+            # The file can be gone already
+            except FileNotFoundError:
+                continue
+            # Unchanged files are skipped by `send_file` anyway
+            if not self.index.is_sent(relative_path, digest):
+                hashes[path] = digest
+        if not hashes:
+            return paths
+
+        reply = self.request({**create_event_headers("have"), "hashes": ",".join(set(hashes.values()))})
+        available = set(reply["hashes"].split(",")) if reply["hashes"] else set()
+        (remaining, linked, size) = ([], 0, 0)
+        for path in paths:
+            if hashes.get(path) not in available:
+                remaining.append(path)
+                continue
+            self._send_link(path, hashes[path])
+            linked += 1
+            size += _get_size(path)
+
+        if linked:
+            sync_shared.info(f"The server made {linked} files ({sync_shared.format_size(size)}) from contents it already had")
+            sync_shared.metrics.inc("sync_client_deduplicated_total", linked)
+            sync_shared.metrics.inc("sync_client_deduplicated_bytes_total", size)
+        return remaining
+
+    def _send_link(self, path: str, digest: str, attempts=0):
+        relative_path = self.get_relative_path(path)
+        event_headers = create_event_headers("link", source_path=path)
+        event_headers.update({"mtime": os.stat(path).st_mtime_ns, **self._version_headers(relative_path, digest)})
+        # The server can't make the file anymore when the other file changed in the meantime, so it is sent after all
+        self.send_event(event_headers, on_ack=lambda: self.index.set_sent(relative_path, digest),
+            retry=lambda attempts: self.send_file(path, attempts=attempts), attempts=attempts)
+
+    def _send_bundles(self, paths: list, directories: list) -> list:
+        """pack the directories and files smaller than BUNDLE_FILE_SIZE into bundles.
+        Returns the files that have to be sent on their own"""
+        large = []
+        # Directories come first, so they exist before the files in them are unpacked
+        bundle = [sync_shared.encode_bundle_entry({"path": self.get_relative_path(path), "directory": True}) for path in directories]
+        bundle_size = sum(len(entry) for entry in bundle)
+        # Index rows of the files in the bundle, stored once the bundle is sent
+        rows = []
+        for path in paths:
+            relative_path = self.get_relative_path(path)
+            try:
+                stat = os.stat(path)
+                if stat.st_size >= sync_shared.BUNDLE_FILE_SIZE:
+                    large.append(path)
+                    continue
+
+                # Skip files that didn't change since they were sent
+                entry = self.index.get_entry(relative_path)
+                if entry is not None and entry[:3] == (stat.st_size, stat.st_mtime_ns, stat.st_ino) and entry[3] == entry[4]:
+                    continue
+                with open(path, 'rb') as f:
+                    data = f.read(sync_shared.BUNDLE_FILE_SIZE)
+            # The file can be gone already
+            except FileNotFoundError:
+                continue
+            if len(data) >= sync_shared.BUNDLE_FILE_SIZE:
+                large.append(path)
+                continue
+
+            digest = hashlib.new(sync_shared.HASH_ALGORITHM, data).hexdigest()
+            rows.append((relative_path, stat.st_size, stat.st_mtime_ns, stat.st_ino, digest, digest))
+            # Touched, but the server has the same contents
+            if entry is not None and entry[4] == digest:
+                continue
+
+            entry_header = {"path": relative_path, "mtime": stat.st_mtime_ns, "file-length": len(data)}
+            if self.bidirectional:
+                entry_header.update({"hash": digest, "base": entry[4] if entry is not None else None})
+            data = sync_shared.encode_bundle_entry(entry_header, data)
+            if bundle_size + len(data) > sync_shared.BUNDLE_MAX_SIZE:
+                self._send_bundle(bundle, rows[:-1])
+                (bundle, bundle_size, rows) = ([], 0, rows[-1:])
+            bundle.append(data)
+            bundle_size += len(data)
+
+        if bundle or rows:
+            self._send_bundle(bundle, rows)
+        return large
+
+    def _send_bundle(self, bundle: list, rows: list, attempts=0):
+        if not bundle:
+            self.index.set_entries(rows)
+            return
+        stream = self._get_stream(None)
+        retry = lambda attempts: self._send_bundle(bundle, rows, attempts)
+        seq = self._begin_operation(stream, [retry, lambda: self.index.set_entries(rows), f"a bundle of {len(bundle)} entries", attempts])
+        payload = sync_shared.encode_bundle({"seq": seq}, bundle)
+        self.scheduler.throttle(len(payload))
+        sync_shared.send(stream, payload, "bundle", codec=self.codec)
+        sync_shared.metrics.inc("sync_client_bytes_sent_total", len(payload), kind="bundle")
+        sync_shared.metrics.inc("sync_client_files_sent_total", len(rows), kind="bundle")
+
+    def request(self, event_headers: dict):
+        """send an event to the server and wait for its reply"""
+        lane = getattr(self._local, "lane", None)
+        (stream, replies, request_lock) = (self._socket, self.replies, self.request_lock) if lane is None else (lane._socket, lane.replies, lane.request_lock)
+        with request_lock:
+            sync_shared.send(stream, event_headers, "event")
+            try:
+                reply = replies.get(timeout=REQUEST_TIMEOUT)
+            except Empty:
+                sync_shared.fail("The server did not reply in time.")
+                sys.exit(1)
+        if isinstance(reply, dict) and "error" in reply:
+            sync_shared.fail(f"The server could not handle the '{event_headers['event-type']}' request: {reply['error']}")
+            sys.exit(1)
+        return reply
+
+    def request_manifest(self) -> dict:
+        """ask the server for a description of its file tree"""
+        manifest = self.request(create_event_headers("manifest"))
+        return {entry["path"]: entry for entry in manifest}
+
+    def _is_unchanged(self, relative_path: str, path: str, stat: os.stat_result) -> bool:
+        """check if a file still has the contents both sides last agreed on"""
+        sent = self.index.get_sent(relative_path)
+        return sent is not None and self.index.get_hash(relative_path, path, stat) == sent
+
+    def _has_changed(self, relative_path: str, path: str, stat: os.stat_result, entry: dict) -> bool:
+        """compare a local file with its manifest entry from the server"""
+        if stat.st_size != entry["size"]:
+            return True
+        # The server only sends the hashes it knows without reading the file
+        remote_hash = entry.get("hash")
+        if stat.st_mtime_ns != entry["mtime"]:
+            # Same size but a different modification time so only the contents can tell, without a hash the file
+            # is sent and large files only send the blocks that differ
+            if remote_hash is None:
+                return True
+            digest = self.index.get_hash(relative_path, path, stat)
+            if digest != remote_hash:
+                return True
+        else:
+            digest = remote_hash if remote_hash is not None else self.index.get_hash(relative_path, path, stat)
+        self.index.set_sent(relative_path, digest)
+        return False
+
     def _parse_args(self):
         """parse cli arguments/config file"""
         # Parse arguments from the cli
@@ -174,6 +1558,21 @@ class ClientSocket:
         parser.add_argument('-i', '--input', help="the directory to watch. Defaults to the current directory")
         parser.add_argument('-s', '--server', default='localhost', help="the servers ip address")
         parser.add_argument('-p', '--port', required=True, type=int, help="the port on the server")
+        parser.add_argument('--buffer-size', default=sync_shared.BUFFER_SIZE, type=int, help="the size of the receive buffer in bytes. Defaults to 1MB")
+        parser.add_argument('--streams', default=DEFAULT_STREAMS, type=int, help=f"the amount of connections that send files in parallel during the initial sync. Defaults to {DEFAULT_STREAMS}")
+        parser.add_argument('--scan-workers', default=sync_shared.SCAN_WORKERS, type=int, help=f"the amount of threads that read directories at the same time during a sync. Defaults to {sync_shared.SCAN_WORKERS}")
+        parser.add_argument('--quiet-period', default=DEFAULT_QUIET_PERIOD, type=float, help=f"the seconds without new changes before changes are sent. Defaults to {DEFAULT_QUIET_PERIOD}")
+        parser.add_argument('--compression', default="none", choices=["none", "auto", *sync_shared.CODECS], help="compress files and large messages with this codec if the server supports it, 'auto' picks the fastest one both sides have. Defaults to none")
+        parser.add_argument('--metrics-port', type=int, help="serve metrics in the Prometheus text format on this port of localhost. Disabled by default")
+        parser.add_argument('--log-format', default="auto", choices=["auto", *sync_shared.LOG_FORMATS], help="write colored output with progress bars (rich), standard log lines (plain) or JSON lines (json). 'auto' uses rich in a terminal and plain otherwise. Defaults to auto")
+        parser.add_argument('--ignore', action='append', default=[], metavar='PATTERN', help="don't sync paths that match this gitignore style pattern, can be given multiple times")
+        parser.add_argument('--ignore-file', action='append', default=[], metavar='FILE', help=f"read gitignore style patterns from this file in the input directory, can be given multiple times. Defaults to {IGNORE_FILE_NAME}")
+        parser.add_argument('--bulk-limit', type=int, metavar='BYTES', help="the bytes per second a sync can send. Unlimited by default")
+        parser.add_argument('--interactive-limit', type=int, metavar='BYTES', help="the bytes per second the changes caught by the watcher can send. Unlimited by default")
+        parser.add_argument('--no-sendfile', action='store_true', help="always read files into a buffer and send it instead of letting the kernel copy them to the socket, e.g. to compare the two")
+        parser.add_argument('--no-snapshots', action='store_true', help="read large files while they may still change instead of from a reflink snapshot. Files that changed while they were sent are always sent again")
+        parser.add_argument('--bidirectional', action='store_true', help="also receive the changes made on the server, if the server watches its output directory")
+        parser.add_argument('-n', '--name', default=socket.gethostname(), help="the name of this client, used by servers that give every client its own directory. Defaults to the hostname")
 
         arguments = []
         if len(sys.argv) > 1:
@@ -193,9 +1592,36 @@ class ClientSocket:
 
         # parse arguments
         args = parser.parse_args(arguments)
+        sync_shared.set_log_format(args.log_format)
         self.server_ip = args.server
         self.port = args.port
+        self.buffer_size = args.buffer_size
+        self.name = args.name
+        # Sent by every connection, so the server knows which changes came from this client
+        self.session = os.urandom(8).hex()
+        self.streams = args.streams
+        self.scan_workers = args.scan_workers
+        self.quiet_period = args.quiet_period
+        self.metrics_port = args.metrics_port
+        self.bidirectional = args.bidirectional
+        self.bulk_limit = args.bulk_limit
+        self.interactive_limit = args.interactive_limit
+        # Turned off as well when the filesystem can't make reflinks
+        self.snapshots = not args.no_snapshots
+        self.use_sendfile = not args.no_sendfile
+        # lzma is too slow to pick automatically
+        if args.compression == "auto":
+            self.compression = ",".join(name for name in sync_shared.CODECS if name != "lzma")
+        else:
+            self.compression = None if args.compression == "none" else args.compression
+        # The codec both sides support, decided during the handshake
+        self.codec = None
         self.input_directory = os.path.abspath(args.input) if args.input else os.getcwd()
+        self.snapshot_directory = os.path.join(self.input_directory, sync_shared.METADATA_DIRECTORY, SNAPSHOT_DIRECTORY)
+        # The ignore files are read again when they change
+        self.ignore_files = [path.replace('\\', '/') for path in args.ignore_file] or [IGNORE_FILE_NAME]
+        self.ignore_patterns = args.ignore
+        self.ignore = self._load_ignore_rules()
     
         # Don't remove entire filesystem safeguard lol
         if self.input_directory.count('/') == 1 or self.input_directory.count('\\') == 1:
@@ -207,6 +1633,9 @@ class ClientSocket:
         try:
             self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self._socket.connect((self.server_ip, self.port))
+            self._receiver = sync_shared.Receiver(self._socket, self.buffer_size)
+            self._handshake(self._socket, self._receiver, self.bidirectional)
+            self.operations[self._socket] = Operations(OPERATION_WINDOW)
             sync_shared.done(f"Connected to {self.server_ip}:{self.port}")
 
             self.connected = True
@@ -219,18 +1648,141 @@ class ClientSocket:
             sync_shared.fail(msg)
             sys.exit(1)
 
+    def _handshake(self, connection: socket.socket, receiver: sync_shared.Receiver, bidirectional=False):
+        """make sure the server speaks the same protocol version and agree on a compression codec.
+        Only the main connection asks for the changes made on the server"""
+        sync_shared.send(connection, {"version": sync_shared.PROTOCOL_VERSION, "name": self.name, "session": self.session, "compression": self.compression, "bidirectional": bidirectional}, "hello")
+        (content_type, _, payload) = sync_shared.receive_frame(receiver)
+        if content_type != "hello":
+            sync_shared.fail(f"The server does not use protocol version {sync_shared.PROTOCOL_VERSION}.")
+            sys.exit(1)
+
+        hello = sync_shared.decode_fields(payload)
+        if bidirectional and not hello.get("bidirectional"):
+            sync_shared.warn("The server doesn't watch its output directory, changes are only sent to the server")
+            self.bidirectional = False
+
+        codec = hello.get("compression")
+        if self.compression is not None and codec != self.codec:
+            if codec is None:
+                sync_shared.warn(f"The server doesn't support {self.compression} compression, files are sent uncompressed")
+            else:
+                sync_shared.info(f"Compressing with {codec}")
+            self.codec = codec
+
+    def _receive_file(self, file_headers: dict):
+        """write a file that changed on the server, unless the local file changed as well and is the newest"""
+        relative_path = file_headers["path"]
+        path = os.path.join(self.input_directory, relative_path)
+        mtime = file_headers["mtime"]
+        if self.ignore and self.ignore.is_ignored(relative_path, False):
+            self._receiver.discard(file_headers["file-length"])
+            return
+        incoming_path = os.path.join(self.input_directory, sync_shared.METADATA_DIRECTORY, INCOMING_NAME)
+        try:
+            f = open(incoming_path, 'wb')
+        except OSError:
+            # Skip the contents so the next frames can still be read
+            self._receiver.discard(file_headers["file-length"])
+            raise
+        with f:
+            self._receiver.recv_into_file(f, file_headers["file-length"])
+        digest = sync_shared.hash_file(incoming_path)
+
+        if os.path.isfile(path):
+            local = self.index.get_hash(relative_path, path)
+            if local == digest:
+                self.index.set_sent(relative_path, digest)
+                os.remove(incoming_path)
+                return
+            if local != self.index.get_sent(relative_path):
+                sync_shared.metrics.inc("sync_client_conflicts_total")
+                # Both sides changed the file, the newest version keeps the path and ties go to the server like on the server
+                if os.stat(path).st_mtime_ns > mtime:
+                    sync_shared.warn(f"'{relative_path}' changed on both sides, keeping the local version")
+                    os.remove(incoming_path)
+                    return
+                conflict = sync_shared.conflict_path(path, self.name)
+                copy2(path, conflict)
+                sync_shared.warn(f"'{relative_path}' changed on both sides, the local version is kept as '{self.get_relative_path(conflict)}'")
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.utime(incoming_path, ns=(mtime, mtime))
+        os.replace(incoming_path, path)
+        # The watcher sees the new file as well, but the index knows the server has it already
+        stat = os.stat(path)
+        self.index.set_entries([(relative_path, stat.st_size, stat.st_mtime_ns, stat.st_ino, digest, digest)])
+        sync_shared.metrics.inc("sync_client_files_received_total")
+        sync_shared.done(f"Received '{relative_path}' from the server")
+
+    def _apply_server_event(self, event_headers: dict):
+        """apply a directory, delete or move event that happened on the server"""
+        relative_path = event_headers["source-path"]
+        path = os.path.join(self.input_directory, relative_path)
+        event_type = event_headers["event-type"]
+        if self.ignore and self.ignore.is_ignored(relative_path, os.path.isdir(path) or event_headers.get("directory", False)):
+            return
+        if event_type == "created":
+            os.makedirs(path, exist_ok=True)
+        elif event_type == "deleted":
+            if not os.path.lexists(path):
+                return
+            # A local change wins over a delete, it is sent to the server again
+            if os.path.isfile(path) and self.index.get_hash(relative_path, path) != self.index.get_sent(relative_path):
+                sync_shared.warn(f"'{relative_path}' was deleted on the server but changed here, keeping it")
+                return
+            if os.path.isdir(path) and not os.path.islink(path):
+                rmtree(path, True)
+            else:
+                os.remove(path)
+            self.index.forget(relative_path)
+            sync_shared.done(f"Deleted '{relative_path}', it was deleted on the server")
+        elif event_type == "moved":
+            relative_destination = event_headers["destination-path"]
+            # Everything inside a moved directory is reported as well, but moved along already
+            if not os.path.lexists(path):
+                return
+            destination = os.path.join(self.input_directory, relative_destination)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            os.replace(path, destination)
+            self.index.move(relative_path, relative_destination)
+            sync_shared.done(f"Moved '{relative_path}' to '{relative_destination}', it was moved on the server")
+
     def _handle_messages(self):
         while self.connected:
-            message_headers = self._socket.recv(sync_shared.HEADER_SIZE).decode(sync_shared.FORMAT)
-            if message_headers:
-                message_headers = json.loads(message_headers)
-            # If an empty message is sent the conncetion was probably closed by the client. The loop continues and self.connected is checked again
-            else:
+            try:
+                (content_type, flags, payload) = sync_shared.receive_frame(self._receiver)
+            # If the connection is closed while the client is still connected the server went away
+            except (OSError, ValueError) as e:
+                if self.connected:
+                    sync_shared.fail(f"Lost the connection to the server: {e}")
+                    self.connected = False
+                break
+
+            # Hand replies over to the thread that is waiting for them
+            if content_type in ("manifest", "signature"):
+                self.replies.put(json.loads(payload))
+                continue
+            elif content_type == "reply":
+                self.replies.put(sync_shared.decode_fields(payload))
+                continue
+            elif content_type == "ack":
+                self.operations[self._socket].acknowledge(sync_shared.decode_fields(payload))
+                continue
+            # Changes made on the server
+            elif content_type in ("file", "event"):
+                headers = sync_shared.decode_fields(payload)
+                try:
+                    if content_type == "file":
+                        self._receive_file(headers)
+                    else:
+                        self._apply_server_event(headers)
+                except OSError as e:
+                    sync_shared.fail(f"Could not apply a change of the server to '{headers.get('path', headers.get('source-path'))}': {e}")
                 continue
 
              # Handle messages
-            msg_length = message_headers["content-length"]
-            msg = self._socket.recv(msg_length).decode(sync_shared.FORMAT)
+            msg = payload.decode(sync_shared.FORMAT)
 
             # Stop the loop if the DISCONNECT_MESSAGE is sent.
             if msg == sync_shared.DISCONNECT_MESSAGE:
@@ -238,6 +1790,8 @@ class ClientSocket:
                 sync_shared.warn(f"[SERVER]: wants to close the connection!")
             else:
                 sync_shared.info(f"[SERVER]: {msg}")
+        # Nothing is acknowledged anymore, don't let the senders wait for it
+        self.operations[self._socket].close()
         print("emd!")
 
 
@@ -246,40 +1800,56 @@ def main():
     global socket_handler
 
     socket_handler = ClientSocket()
-    socket_handler.sync()
 
     # Init watchdog file observers
     event_handler = MyHandler()
     observer = Observer()
     observer.schedule(event_handler,  path=socket_handler.input_directory,  recursive=True)
 
+    # Changes made during the initial sync are sent right away instead of after it
     sync_shared.info(f"Watching directory {socket_handler.input_directory}")
+    socket_handler.events.start()
     observer.start()
 
+    exit_code = 0
     # Keep looping until the user stops the program (ctrl+c), is checked every second
     try:
+        socket_handler.sync()
         while socket_handler.connected:
-            time.sleep(1)
+            if socket_handler.sync_requested.wait(1):
+                socket_handler.sync_requested.clear()
+                socket_handler.sync()
     except KeyboardInterrupt:
         observer.stop()
         observer.join()
+        # Send the changes that are still waiting
+        socket_handler.events.stop()
 
         # Properly close the connection
         sync_shared.warn("Disconnecting from the server...")
         socket_handler.connected = False
         socket_handler.send(sync_shared.DISCONNECT_MESSAGE)
     except:
-        # Properly close the connection
+        # Properly close the connection, if the server is still there
         sync_shared.warn("Disconnecting from the server...")
         socket_handler.connected = False
-        socket_handler.send(sync_shared.DISCONNECT_MESSAGE)
+        exit_code = 1
+        try:
+            socket_handler.send(sync_shared.DISCONNECT_MESSAGE)
+        except (OSError, SystemExit):
+            pass
 
     # The connection is closed at thist moment
     sync_shared.done("Disconnected from the server")
     
     socket_handler.incoming_thread.join()
-    socket_handler._socket.shutdown(socket.SHUT_RDWR)
+    try:
+        socket_handler._socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        # The server closed the connection already
+        pass
     socket_handler._socket.close()
+    sys.exit(exit_code)
 
 
 if __name__ == "__main__":
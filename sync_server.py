@@ -1,26 +1,311 @@
 #!/usr/bin/python3
 
+import hashlib
 import json
 import os
+import selectors
 import socket
 import sys
+import time
 from argparse import ArgumentParser
+from contextlib import ExitStack, contextmanager
 from genericpath import isfile
-from shutil import rmtree
-import rich.progress
+from queue import Empty, Queue
+from shutil import copy2, rmtree
+from stat import S_ISDIR, S_ISREG
+from threading import Lock, Thread
 import traceback
 
 import sync_shared
 
+# Only needed to send changes on the server back to the clients
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+# Seconds the accept loop waits for a new connection before checking again
+ACCEPT_TIMEOUT = 1
+# Seconds to wait for the connection threads to finish when the server stops
+STOP_TIMEOUT = 5
+# Directory inside the metadata directory of the output that holds files that are still being received
+PARTIAL_DIRECTORY = "partial"
+# Seconds without new changes in the output directory before they are sent to the clients
+PUSH_QUIET_PERIOD = 0.2
+# Maximum seconds changes are held back when the output directory keeps changing
+PUSH_MAX_DELAY = 2
+# Seconds a change applied for a client is remembered, so the watcher doesn't send it back to the same client
+APPLIED_TTL = 10
+# Default amount of buffers between receiving a file and writing it, per connection
+DEFAULT_WRITE_BUFFERS = 8
+# Files smaller than this aren't preallocated, it isn't worth the extra call
+PREALLOCATE_MIN_SIZE = 1024 * 1024
+# When written files are fsynced before their operation is acknowledged: never, one by one or in batches
+FSYNC_POLICIES = ("none", "file", "batch")
+# Default amount of operations and milliseconds that are collected into one batch of fsyncs
+DEFAULT_FSYNC_BATCH = 64
+DEFAULT_FSYNC_DELAY = 50
+
+sync_shared.metrics.describe("sync_server_clients", "gauge", "connections that are currently handled")
+sync_shared.metrics.describe("sync_server_bytes_received_total", "counter", "bytes of file contents received, after compression")
+sync_shared.metrics.describe("sync_server_files_received_total", "counter", "files written to the output directory")
+sync_shared.metrics.describe("sync_server_apply_seconds", "histogram", "seconds it took to receive and apply an operation")
+sync_shared.metrics.describe("sync_server_nacks_total", "counter", "operations that could not be applied")
+sync_shared.metrics.describe("sync_server_deduplicated_total", "counter", "files made from contents the server already had instead of receiving them")
+sync_shared.metrics.describe("sync_server_deduplicated_bytes_total", "counter", "bytes that didn't have to be received because the server already had them")
+sync_shared.metrics.describe("sync_server_pushes_total", "counter", "changes on the server sent to clients")
+sync_shared.metrics.describe("sync_server_conflicts_total", "counter", "files that changed on the client and the server at the same time")
+sync_shared.metrics.describe("sync_server_fsync_seconds", "histogram", "seconds it took to fsync a batch of written files")
+sync_shared.metrics.describe("sync_server_fsyncs_total", "counter", "files and directories that were fsynced")
+sync_shared.metrics.describe("sync_server_stale_transfers_total", "counter", "files that changed on the client while they were sent and were thrown away")
+
+
+class PathLocks:
+    """hands out a lock per path, so clients that share an output directory never write the same path at the same time"""
+
+    def __init__(self):
+        self._lock = Lock()
+        # path -> [lock, amount of threads using the lock]
+        self._locks = {}
+
+    @contextmanager
+    def lock(self, *paths: str):
+        # Always lock in the same order, so two threads that lock the same paths can't wait on each other
+        with ExitStack() as stack:
+            for path in sorted(set(paths)):
+                stack.enter_context(self._lock_path(path))
+            yield
+
+    @contextmanager
+    def _lock_path(self, path: str):
+        with self._lock:
+            entry = self._locks.setdefault(path, [Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+        try:
+            yield
+        finally:
+            entry[0].release()
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[path]
+
+
+class HashIndex:
+    """the content hashes of the files in the output directory, by path and by hash. A hash is only valid while the size
+    and mtime of the file stay the same"""
+
+    def __init__(self):
+        self._lock = Lock()
+        # path -> (size, mtime, hash)
+        self._by_path = {}
+        # hash -> paths with these contents
+        self._by_hash = {}
+        # Lists of (path, stat) to hash in the background, started with the first list
+        self._unhashed = Queue()
+        self._thread = None
+
+    def get(self, path: str, stat: os.stat_result) -> str | None:
+        """get the hash of a file if it's known for this size and mtime, without reading the file"""
+        with self._lock:
+            cached = self._by_path.get(path)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+        return None
+
+    def hash_file(self, path: str, stat: os.stat_result) -> str:
+        """hash a file, reusing the previous hash if the file didn't change since. Raises OSError if the file is gone
+        or doesn't have `stat` anymore once it's hashed"""
+        digest = self.get(path, stat)
+        if digest is not None:
+            return digest
+
+        digest = sync_shared.hash_file(path)
+        current = os.stat(path)
+        if (current.st_size, current.st_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            raise OSError(f"'{path}' changed while it was hashed")
+        self.store(path, stat, digest)
+        return digest
+
+    def hash_later(self, files: list):
+        """hash the (path, stat) of files on a background thread, so later manifests and deduplication know them"""
+        if not files:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._hash_unhashed, daemon=True)
+                self._thread.start()
+        self._unhashed.put(files)
+
+    def _hash_unhashed(self):
+        while True:
+            for (path, stat) in self._unhashed.get():
+                try:
+                    self.hash_file(path, stat)
+                except OSError:
+                    # Changed or gone meanwhile, it's hashed again when it's needed
+                    pass
+
+    def store(self, path: str, stat: os.stat_result, digest: str):
+        """remember the hash of a file that was just written"""
+        with self._lock:
+            self._discard(path)
+            self._by_path[path] = (stat.st_size, stat.st_mtime_ns, digest)
+            self._by_hash.setdefault(digest, set()).add(path)
+
+    def move(self, source: str, destination: str):
+        """keep the hashes of moved files, a move doesn't change the size or mtime"""
+        prefix = source + os.sep
+        with self._lock:
+            for path in [path for path in self._by_path if path == source or path.startswith(prefix)]:
+                entry = self._by_path[path]
+                self._discard(path)
+                new_path = destination + path[len(source):]
+                self._discard(new_path)
+                self._by_path[new_path] = entry
+                self._by_hash.setdefault(entry[2], set()).add(new_path)
+
+    def find(self, digest: str, directory: str) -> str | None:
+        """find a file below `directory` that still has these contents"""
+        with self._lock:
+            paths = list(self._by_hash.get(digest, ()))
+        for path in paths:
+            if not path.startswith(directory + os.sep):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            with self._lock:
+                cached = self._by_path.get(path)
+                if stat is not None and S_ISREG(stat.st_mode) and cached == (stat.st_size, stat.st_mtime_ns, digest):
+                    return path
+                # Changed or gone since it was hashed
+                if cached is not None and cached[2] == digest:
+                    self._discard(path)
+        return None
+
+    def _discard(self, path: str):
+        entry = self._by_path.pop(path, None)
+        if entry is not None:
+            paths = self._by_hash[entry[2]]
+            paths.discard(path)
+            if not paths:
+                del self._by_hash[entry[2]]
+
+
+class Syncer:
+    """makes written files durable according to the fsync policy before their operations are acknowledged.
+    The fsyncs run on their own thread, so the connections keep receiving while the disk flushes"""
+
+    def __init__(self, policy: str, batch_size: int, batch_delay: float):
+        self.policy = policy
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        # (paths, on_synced) of the operations that wait for their fsync, None stops the thread
+        self._queue = Queue()
+        self._thread = None
+        if policy != "none":
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def submit(self, paths: list, on_synced):
+        """call `on_synced(error)` once the paths that were written, created, deleted or moved are on the disk"""
+        if self._thread is None or not paths:
+            on_synced(None)
+            return
+        self._queue.put((paths, on_synced))
+
+    def close(self):
+        """fsync the operations that are still waiting and stop"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            # Wait a little for more operations, so they share the wait for the disk
+            deadline = time.monotonic() + self.batch_delay
+            while self.policy == "batch" and len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except Empty:
+                    break
+                if item is None:
+                    stopped = True
+                    break
+                batch.append(item)
+            self._sync(batch)
+
+    def _sync(self, batch: list):
+        started = time.perf_counter()
+        errors = {}
+        # The renames into the directories have to be durable as well, like the deletes and renames out of them
+        directories = set()
+        for (number, (paths, _)) in enumerate(batch):
+            for path in paths:
+                directories.add(os.path.dirname(path))
+                try:
+                    _fsync_path(path)
+                except FileNotFoundError:
+                    # Deleted or moved away, only its directory has to be fsynced
+                    continue
+                except OSError as e:
+                    errors[number] = e
+        for directory in directories:
+            try:
+                _fsync_path(directory)
+            except OSError:
+                # Not every filesystem can fsync a directory
+                pass
+        sync_shared.metrics.observe("sync_server_fsync_seconds", time.perf_counter() - started)
+        sync_shared.metrics.inc("sync_server_fsyncs_total", sum(len(paths) for (paths, _) in batch) + len(directories))
+
+        for (number, (_, on_synced)) in enumerate(batch):
+            on_synced(errors.get(number))
+
+
+def _fsync_path(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 class ServerSocketHandler:
     _socket: socket.socket
     host: str
     port: int
     output_path: str
-    message_headers = {}
+    buffer_size: int
+    use_splice: bool
+    per_client: bool
+    metrics_port: int | None
+    bidirectional: bool
+    hardlinks: bool
+    write_buffers: int
 
     def __init__(self):
         self._parse_args()
+        # Hashes of the files in the output directory, to compare them with the client and to find the same contents
+        self.hashes = HashIndex()
+        self.path_locks = PathLocks()
+        self.syncer = Syncer(self.fsync, self.fsync_batch, self.fsync_delay / 1000)
+        # The connections that are currently handled
+        self.clients = set()
+        self._clients_lock = Lock()
+        # Changes in the output directory that have to be sent to the bidirectional clients
+        self.pushes = Queue()
+        # Paths changed on behalf of a client -> (session of the client, state of the path afterwards, time)
+        self.applied = {}
+        self._applied_lock = Lock()
         sync_shared.info("Logging from SERVER side")
 
     def _parse_args(self):
@@ -30,6 +315,17 @@ class ServerSocketHandler:
         parser.add_argument('-o', '--output', help="the directory to output to. Defaults to the current directory")
         parser.add_argument('--host', default="localhost", help="the host to bind the socket to. Defaults to localhost")
         parser.add_argument('-p', '--port', required=True, type=int, help="the port to bind the server to")
+        parser.add_argument('--buffer-size', default=sync_shared.BUFFER_SIZE, type=int, help="the size of the receive buffer in bytes. Defaults to 1MB")
+        parser.add_argument('--write-buffers', default=DEFAULT_WRITE_BUFFERS, type=int, help=f"the amount of receive buffers that can wait for the disk, so receiving goes on while files are written. 0 writes files on the receiving thread. Defaults to {DEFAULT_WRITE_BUFFERS}")
+        parser.add_argument('--no-splice', action='store_true', help="always copy received files through the receive buffer instead of splicing them in the kernel, when files are written on the receiving thread")
+        parser.add_argument('--fsync', default="none", choices=FSYNC_POLICIES, help="make written files durable before they are acknowledged: never, one by one or in batches. Defaults to none")
+        parser.add_argument('--fsync-batch', default=DEFAULT_FSYNC_BATCH, type=int, help=f"the maximum amount of operations fsynced in one batch. Defaults to {DEFAULT_FSYNC_BATCH}")
+        parser.add_argument('--fsync-delay', default=DEFAULT_FSYNC_DELAY, type=float, help=f"the milliseconds a batch waits for more operations before it is fsynced. Defaults to {DEFAULT_FSYNC_DELAY}")
+        parser.add_argument('--per-client', action='store_true', help="give every client its own directory inside the output directory, named after the client")
+        parser.add_argument('--metrics-port', type=int, help="serve metrics in the Prometheus text format on this port of the host. Disabled by default")
+        parser.add_argument('--hardlinks', action='store_true', help="make files with contents the server already has as hard links instead of copies, when only the server replaces files")
+        parser.add_argument('--bidirectional', action='store_true', help="watch the output directory and send changes made on the server back to clients that ask for it")
+        parser.add_argument('--log-format', default="auto", choices=["auto", *sync_shared.LOG_FORMATS], help="write colored output with progress bars (rich), standard log lines (plain) or JSON lines (json). 'auto' uses rich in a terminal and plain otherwise. Defaults to auto")
 
         arguments = []
         if len(sys.argv) > 1:
@@ -48,8 +344,22 @@ class ServerSocketHandler:
                     arguments.append(val)
 
         args = parser.parse_args(arguments)
+        sync_shared.set_log_format(args.log_format)
         self.host = args.host
         self.port = args.port
+        self.buffer_size = args.buffer_size
+        self.use_splice = not args.no_splice
+        self.write_buffers = args.write_buffers
+        self.fsync = args.fsync
+        self.fsync_batch = args.fsync_batch
+        self.fsync_delay = args.fsync_delay
+        self.per_client = args.per_client
+        self.metrics_port = args.metrics_port
+        self.bidirectional = args.bidirectional
+        self.hardlinks = args.hardlinks
+        if self.bidirectional and Observer is None:
+            sync_shared.fail("The watchdog package is needed to watch the output directory")
+            sys.exit(1)
         # Convert the given path argument to an absolute path
         self.output_path = os.path.abspath(args.output) if args.output is not None else os.getcwd()
 
@@ -58,154 +368,841 @@ class ServerSocketHandler:
             sync_shared.fail("Can't choose this directory! Be careful this would destroy your file system")
             sys.exit(1)
 
-    def start(self):
-        """listen to an incoming connection and end program when the connection is closed"""
+    def serve(self):
+        """accept connections until the server is stopped, every connection is handled on its own thread"""
+        selector = selectors.DefaultSelector()
+        selector.register(self._socket, selectors.EVENT_READ)
         try:
-            (connection, adress) = self._socket.accept()
+            while True:
+                for _ in selector.select(timeout=ACCEPT_TIMEOUT):
+                    (connection, adress) = self._socket.accept()
+                    client = ClientConnection(self, connection, adress)
+                    with self._clients_lock:
+                        self.clients.add(client)
+                    sync_shared.metrics.inc("sync_server_clients")
+                    client.thread = Thread(target=self._run_client, args=(client,), daemon=True)
+                    client.thread.start()
+        except KeyboardInterrupt:
+            sync_shared.warn("Stopping the server...")
+        finally:
+            selector.close()
 
-            sync_shared.done(f"Connection accepted from {adress[0]}:{adress[1]}")
-            connected = True
-            while connected:
-                message_headers = connection.recv(sync_shared.HEADER_SIZE).decode(sync_shared.FORMAT)
-                if message_headers:
-                    self.message_headers = json.loads(message_headers)
+        # Close the remaining connections so their threads stop
+        with self._clients_lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.close()
+        for client in clients:
+            client.thread.join(STOP_TIMEOUT)
+        self.syncer.close()
+
+    def _run_client(self, client: 'ClientConnection'):
+        try:
+            client.start()
+        finally:
+            with self._clients_lock:
+                self.clients.discard(client)
+            sync_shared.metrics.inc("sync_server_clients", -1)
+
+    def get_output_path(self, name: str) -> str:
+        """get the directory a client outputs to"""
+        if not self.per_client:
+            return self.output_path
+        name = sync_shared.NAME_PATTERN.sub('_', name).strip('.') or "client"
+        return os.path.join(self.output_path, name)
+
+    def watch(self) -> 'Observer':
+        """watch the output directory and send its changes to the bidirectional clients"""
+        os.makedirs(self.output_path, exist_ok=True)
+        observer = Observer()
+        observer.schedule(OutputHandler(self), path=self.output_path, recursive=True)
+        observer.start()
+        Thread(target=self._push_changes, daemon=True).start()
+        sync_shared.info(f"Watching output directory {self.output_path}")
+        return observer
+
+    def is_internal(self, path: str) -> bool:
+        """check if a path is only used by the server itself, like partial files and delta files"""
+        relative_path = os.path.relpath(path, self.output_path)
+        return sync_shared.METADATA_DIRECTORY in relative_path.split(os.sep)
 
-                    # Handle content types that aren't messages
-                    if self.message_headers["content-type"] == "file":
-                        self._handle_file(connection)
+    def _push_changes(self):
+        """send the changes in the output directory to the bidirectional clients, a burst of changes is sent at once"""
+        while True:
+            batch = [self.pushes.get()]
+            deadline = time.monotonic() + PUSH_MAX_DELAY
+            try:
+                while time.monotonic() < deadline:
+                    batch.append(self.pushes.get(timeout=PUSH_QUIET_PERIOD))
+            except Empty:
+                pass
+
+            # Only the last contents of a changed file are sent
+            files = set()
+            changes = []
+            for change in batch:
+                if change[0] == "file":
+                    if change[1] in files:
                         continue
-                    elif self.message_headers["content-type"] == "event":
-                        self._handle_event(connection)
+                    files.add(change[1])
+                changes.append(change)
+
+            now = time.monotonic()
+            with self._applied_lock:
+                for path in [path for (path, origin) in self.applied.items() if now - origin[2] > APPLIED_TTL]:
+                    del self.applied[path]
+                origins = {change[1]: self.applied.get(change[1]) for change in changes}
+            with self._clients_lock:
+                clients = [client for client in self.clients if client.bidirectional]
+
+            for change in changes:
+                origin = origins[change[1]]
+                # Don't send a change back to the client it came from, unless the path changed again since
+                if origin is not None and origin[1] != _get_state(change[1]):
+                    origin = None
+                for client in list(clients):
+                    if origin is not None and origin[0] == client.session:
                         continue
+                    try:
+                        client.push(change)
+                    except (Exception, SystemExit) as e:
+                        # Only this client is dropped, its connection thread cleans up
+                        sync_shared.fail(f"Could not send a change to '{client.name}': {e}")
+                        clients.remove(client)
+                        client.close()
+
+    def record_applied(self, client: 'ClientConnection', path: str, target: str = None):
+        """remember that a path was changed on behalf of a client. Contents that went to a conflict copy (`target`)
+        instead are new to the client as well"""
+        if self.bidirectional and (target is None or target == path):
+            state = _get_state(path)
+            with self._applied_lock:
+                self.applied[path] = (client.session, state, time.monotonic())
 
-                    # Handle messages
-                    msg_length = self.message_headers["content-length"]
-                    msg = connection.recv(msg_length).decode(sync_shared.FORMAT)
 
-                    # Stop the loop if the DISCONNECT_MESSAGE is sent.
-                    if msg == sync_shared.DISCONNECT_MESSAGE:
-                        connected = False
-                        sync_shared.warn(f"[{adress[0]}:{adress[1]}]: wants to close the connection!")
+def _get_state(path: str) -> tuple | None:
+    """get the type, mtime and size of a path, or None if it doesn't exist. The mtime of a directory changes with its
+    contents, so only its type is compared"""
+    try:
+        stat = os.lstat(path)
+    except OSError:
+        return None
+    if S_ISDIR(stat.st_mode):
+        return ("directory",)
+    return ("file" if S_ISREG(stat.st_mode) else "other", stat.st_mtime_ns, stat.st_size)
+
+
+class OutputHandler:
+    """queues the watchdog events of the output directory so they can be sent to the clients"""
+
+    def __init__(self, server: ServerSocketHandler):
+        self.server = server
+
+    def dispatch(self, event):
+        server = self.server
+        if event.event_type in ("created", "modified"):
+            # Directories are modified whenever something inside them changes
+            if server.is_internal(event.src_path) or event.is_directory and event.event_type == "modified":
+                return
+            server.pushes.put(("directory" if event.is_directory else "file", event.src_path))
+        elif event.event_type == "deleted":
+            if not server.is_internal(event.src_path):
+                server.pushes.put(("deleted", event.src_path))
+        elif event.event_type == "moved":
+            # Received files are moved into place from the partial directory
+            if server.is_internal(event.src_path):
+                if not server.is_internal(event.dest_path):
+                    server.pushes.put(("directory" if event.is_directory else "file", event.dest_path))
+            elif server.is_internal(event.dest_path):
+                server.pushes.put(("deleted", event.src_path))
+            else:
+                server.pushes.put(("moved", event.src_path, event.dest_path))
+
+
+class ClientConnection:
+    """handles the messages of a single connected client"""
+    connection: socket.socket
+    adress: tuple
+    output_path: str
+    receiver: sync_shared.Receiver
+    thread: Thread
+
+    def __init__(self, server: ServerSocketHandler, connection: socket.socket, adress: tuple):
+        self.server = server
+        self.connection = connection
+        self.adress = adress
+        self.output_path = server.output_path
+        # Compression codec for large replies, decided during the handshake
+        self.codec = None
+        self.name = None
+        # Shared by all connections of a client, changes are never sent back to the client they came from
+        self.session = None
+        # Whether the changes made on the server are pushed over this connection
+        self.bidirectional = False
+        # Changes on the server are sent from another thread
+        self.send_lock = Lock()
+        self.receiver = sync_shared.Receiver(connection, server.buffer_size, server.use_splice)
+        # Writes received files while the next data is received
+        self.writer = sync_shared.FileWriter(server.buffer_size, server.write_buffers) if server.write_buffers > 0 else None
+        self.closing = False
+        # Acknowledgements of the fsync thread are dropped once the connection is gone
+        self.closed = False
+
+    def start(self):
+        """handle messages of the client until the connection is closed"""
+        connection = self.connection
+        adress = self.adress
+        try:
+            sync_shared.done(f"Connection accepted from {adress[0]}:{adress[1]}")
+            connected = self._handshake(connection)
+            while connected:
+                (content_type, flags, payload) = sync_shared.receive_frame(self.receiver)
+
+                # Handle content types that aren't messages
+                if content_type in ("file", "delta", "event", "bundle"):
+                    started = time.perf_counter()
+                    if content_type == "file":
+                        self._handle_file(connection, sync_shared.decode_fields(payload))
+                    elif content_type == "delta":
+                        self._handle_delta(connection, sync_shared.decode_fields(payload))
+                    elif content_type == "event":
+                        self._handle_event(connection, sync_shared.decode_fields(payload))
                     else:
-                        sync_shared.info(f"[{adress[0]}:{adress[1]}]: {msg}")
+                        self._handle_bundle(connection, payload)
+                    sync_shared.metrics.observe("sync_server_apply_seconds", time.perf_counter() - started, kind=content_type)
+                    continue
+
+                # Handle messages
+                msg = payload.decode(sync_shared.FORMAT)
+
+                # Stop the loop if the DISCONNECT_MESSAGE is sent.
+                if msg == sync_shared.DISCONNECT_MESSAGE:
+                    connected = False
+                    sync_shared.warn(f"[{adress[0]}:{adress[1]}]: wants to close the connection!")
+                else:
+                    sync_shared.info(f"[{adress[0]}:{adress[1]}]: {msg}")
 
         # Send a disconnect message to the client when an error occurs
         except socket.error as err:
-            sync_shared.fail("A socket error occured:")
-            sync_shared.fail(str(err))
-            sync_shared.warn("Closing connection")
-            sync_shared.send(connection, sync_shared.DISCONNECT_MESSAGE)
-            self._socket.shutdown(socket.SHUT_RDWR)
-            self._socket.close()
+            # The connection is closed on purpose when the server stops
+            if not self.closing:
+                sync_shared.fail(f"A socket error occured with {adress[0]}:{adress[1]}:")
+                sync_shared.fail(str(err))
+                sync_shared.warn("Closing connection")
+                self._send_disconnect()
         except Exception as e:
-            sync_shared.fail("An error has occured:")
+            sync_shared.fail(f"An error has occured with {adress[0]}:{adress[1]}:")
             traceback.print_exception(e)
             sync_shared.warn("Closing connection")
-            sync_shared.send(connection, sync_shared.DISCONNECT_MESSAGE)
-            self._socket.shutdown(socket.SHUT_RDWR)
-            self._socket.close()
+            self._send_disconnect()
         finally:
+            self.closed = True
+            self.receiver.close()
+            if self.writer is not None:
+                self.writer.close()
             connection.close()
 
-        # The connection was closed by the user or an error occurred so the socket can be closed on the server side
-        sync_shared.done("Connection closed")
+        # The connection was closed by the user or an error occurred, the server keeps accepting new connections
+        sync_shared.done(f"Connection with {adress[0]}:{adress[1]} closed")
+
+    def close(self):
+        """stop handling the client by closing its connection"""
+        self.closing = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _send_disconnect(self):
+        try:
+            self.connection.sendall(sync_shared.encode_frame(sync_shared.DISCONNECT_MESSAGE))
+        except OSError:
+            # The client is already gone
+            pass
+
+    def _send(self, message: str | dict, content_type="message", codec=None):
+        with self.send_lock:
+            sync_shared.send(self.connection, message, content_type, codec=codec)
 
-    def _handle_file(self, conn: socket.socket):
-        # get the file header length
-        file_header_length = self.message_headers["content-length"]
-        # wait for the file headers
-        file_headers = conn.recv(file_header_length).decode(sync_shared.FORMAT)
-        file_headers = json.loads(file_headers)
+    def _handshake(self, conn: socket.socket) -> bool:
+        """check that the client speaks the same protocol version"""
+        (content_type, _, payload) = sync_shared.receive_frame(self.receiver)
+        hello = sync_shared.decode_fields(payload) if content_type == "hello" else {}
 
+        if hello.get("version") != sync_shared.PROTOCOL_VERSION:
+            sync_shared.fail(f"Client uses protocol version {hello.get('version')}, but the server uses version {sync_shared.PROTOCOL_VERSION}")
+            self._send(sync_shared.DISCONNECT_MESSAGE)
+            return False
+
+        # Clients get their own directory or share the output directory
+        name = hello.get("name") or f"{self.adress[0]}"
+        self.name = name
+        self.session = hello.get("session") or f"{self.adress[0]}:{self.adress[1]}"
+        self.output_path = self.server.get_output_path(name)
+        os.makedirs(self.output_path, exist_ok=True)
+        sync_shared.info(f"Client '{name}' outputs to {self.output_path}")
+
+        # Compress with the first codec the client offers that is available here as well
+        self.codec = sync_shared.choose_codec(hello.get("compression"))
+        self.bidirectional = bool(hello.get("bidirectional")) and self.server.bidirectional
+        self._send({"version": sync_shared.PROTOCOL_VERSION, "compression": self.codec, "bidirectional": self.bidirectional}, "hello")
+        return True
+
+    def _handle_file(self, conn: socket.socket, file_headers: dict):
         # total length of the file that will be sent
         total_length = int(file_headers["file-length"])
+        mtime = file_headers.get("mtime")
+        relative_path = file_headers["path"]
+        codec = file_headers.get("compression")
+        # A transfer that broke off continues at the last checkpoint
+        offset = file_headers.get("offset", 0)
 
-        # Show progress bar
-        
-        path = os.path.join(self.output_path, file_headers["path"])
-
-        with rich.progress.Progress(
-            rich.progress.TextColumn("{task.description}"),
-            rich.progress.BarColumn(),
-            rich.progress.FileSizeColumn(),
-            rich.progress.TotalFileSizeColumn(),
-            rich.progress.TimeRemainingColumn()
-        ) as progress:
-            write_task = progress.add_task(f"Writing {file_headers['path']}...", total=total_length)
-            with open(path, 'wb') as f:
-                should_end = False
-                while should_end == False and total_length > 0:
-                    # The next buffer size will always be the constant MTU, except if the remaining file length is smaller than the MTU.
-                    if total_length < sync_shared.MTU:
-                        next_buffer_size = total_length
-                    else:
-                        next_buffer_size = sync_shared.MTU
-                    # Decrease the total length of the remaining bytes sent
-                    total_length -= next_buffer_size
-
-                    # Wait for the data from the client and append it to the file
-                    data = conn.recv(next_buffer_size)
-
-                    if not data and total_length == 0:
-                        should_end = True
-                    # Something went wrong with sending the data
-                    elif not data:
-                        total_length += next_buffer_size
-                        continue
+        try:
+            path = self._resolve_path(relative_path)
+        except ValueError as e:
+            self.receiver.discard(total_length - offset, codec)
+            self._is_stale(file_headers)
+            self._acknowledge(conn, file_headers, e)
+            return
+        (partial_path, state_path) = self._get_partial_paths(relative_path)
+        with self.server.path_locks.lock(path):
+            try:
+                (f, digest) = self._open_partial(relative_path, path, partial_path, state_path, offset, total_length)
+            except (OSError, ValueError) as e:
+                # Skip the contents so the next frames can still be read
+                self.receiver.discard(total_length - offset, codec)
+                self._is_stale(file_headers)
+                self._acknowledge(conn, file_headers, e)
+                return
 
-                    f.write(data)
+            # Show progress bar, small files are written too fast to watch
+            with sync_shared.ProgressView(f"Writing {relative_path}...", total_length, offset, show=total_length - offset >= sync_shared.PROGRESS_MIN_SIZE) as progress:
+                on_progress = progress.advance
+                (received, cpu_time) = (0, 0.0)
+                with f:
+                    while offset < total_length:
+                        # Receive up to the next checkpoint
+                        count = min(total_length - offset, sync_shared.RESUME_CHECKPOINT - offset % sync_shared.RESUME_CHECKPOINT)
+                        if codec is not None:
+                            (chunk_received, chunk_cpu_time) = self.receiver.recv_compressed_into_file(f, count, codec, on_progress, self.writer)
+                            received += chunk_received
+                            cpu_time += chunk_cpu_time
+                        else:
+                            # Write the data straight from the receive buffer to the file
+                            self.receiver.recv_into_file(f, count, on_progress, self.writer)
+                        offset += count
+                        if offset < total_length:
+                            self._wait_for_writer()
+                            digest = self._save_checkpoint(f, state_path, file_headers, offset - count, offset, digest)
+                    self._wait_for_writer()
 
-                    progress.update(write_task, advance=next_buffer_size)
+            if self._is_stale(file_headers):
+                os.remove(partial_path)
+                if os.path.exists(state_path):
+                    os.remove(state_path)
+                self._acknowledge(conn, file_headers)
+                return
 
-        # TODO?: send a receipt back
+            try:
+                target = self._resolve_conflict(path, file_headers)
+                os.replace(partial_path, target)
+                if os.path.exists(state_path):
+                    os.remove(state_path)
 
-    def _handle_event(self, conn: socket.socket):
-        """handle all content-type: 'event' messages from the client"""
-        # get the file header length
-        event_header_length = int(self.message_headers["content-length"])
-        # wait for the event headers
-        event_headers = conn.recv(event_header_length).decode(sync_shared.FORMAT)
-        event_headers = json.loads(event_headers) 
+                # Keep the modification time of the client so the manifest can be compared without hashing
+                if mtime is not None:
+                    os.utime(target, ns=(mtime, mtime))
+                self._store_hash(target, file_headers)
+                self.server.record_applied(self, path, target)
+            except OSError as e:
+                self._acknowledge(conn, file_headers, e)
+                return
 
-        if "source-path" in event_headers:
-            relative_source = event_headers["source-path"]
-            event_headers["source-path"] = os.path.join(self.output_path, event_headers["source-path"])
+        if codec is not None and received:
+            sync_shared.done(f"Received '{relative_path}' as {sync_shared.format_size(received)} with {codec}, {cpu_time * 1000:.1f}ms to decompress")
+        sync_shared.metrics.inc("sync_server_bytes_received_total", received or total_length - file_headers.get("offset", 0), kind="file")
+        sync_shared.metrics.inc("sync_server_files_received_total", kind="file")
+        self._acknowledge_synced(conn, file_headers, [target])
 
-        try:
-            if event_headers["event-type"] == "created":
-                if event_headers["directory"]:
-                    os.mkdir(event_headers["source-path"])
-                else:
-                    f = open(event_headers["source-path"], 'wb')
-                    f.close()
-                
-                sync_shared.done(f"Created { 'directory' if event_headers['directory'] else 'file' } '{relative_source}'")
-            elif event_headers["event-type"] == "clear":
-                f = open(event_headers["source-path"], 'wb')
+    def _is_stale(self, headers: dict) -> bool:
+        """read the trailer that follows the contents of a file if the client announced one.
+        A stale file changed on the client while it was read, so the received contents are thrown away"""
+        if not headers.get("trailer"):
+            return False
+        (content_type, _, payload) = sync_shared.receive_frame(self.receiver)
+        if content_type != "trailer":
+            raise ValueError(f"Expected the trailer of '{headers['path']}', received a {content_type} frame")
+        if not sync_shared.decode_fields(payload)["stale"]:
+            return False
+        sync_shared.warn(f"Threw '{headers['path']}' away, it changed on the client while it was sent")
+        sync_shared.metrics.inc("sync_server_stale_transfers_total")
+        return True
+
+    def _open_partial(self, relative_path: str, path: str, partial_path: str, state_path: str, offset: int, total_length: int) -> tuple:
+        """open the partial file to receive a file in and get the hash of the part that is already there"""
+        # Files can arrive over another stream than the event that created their directory
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.makedirs(os.path.dirname(partial_path), exist_ok=True)
+
+        digest = ""
+        if offset:
+            state = self._load_partial_state(state_path)
+            if state is None or state["offset"] != offset:
+                raise ValueError(f"Can't continue '{relative_path}' at {offset} bytes, the saved part is gone")
+            digest = state["hash"]
+            sync_shared.info(f"Continuing '{relative_path}' at {sync_shared.format_size(offset)}")
+
+        # Write next to the output directory and only replace the file once it is complete,
+        # so a broken connection never leaves a truncated file behind
+        f = open(partial_path, 'r+b' if offset else 'w+b')
+        f.seek(offset)
+        f.truncate()
+        if total_length - offset >= PREALLOCATE_MIN_SIZE:
+            try:
+                sync_shared.preallocate(f, offset, total_length - offset)
+            except OSError:
                 f.close()
+                raise
+        return (f, digest)
 
-                sync_shared.done(f"Cleared file '{relative_source}'")
-            elif event_headers["event-type"] == "deleted":
-                # Try to delete path as a file, if that errors it must be a directory.
-                # This workaround is needed, because watchdog can't determine wether a deleted path was a directory or not
-                try:
-                    os.remove(event_headers["source-path"])
-                except:
-                    rmtree(event_headers["source-path"], True)
-
-                sync_shared.done(f"Deleted '{relative_source}'")
-            elif event_headers["event-type"] == "sync":
-                # Remove old tree and make new directory.
-                sync_shared.info("Syncing file tree...")
-
-                rmtree(self.output_path, True)
-                os.mkdir(self.output_path)
-                
+    def _wait_for_writer(self):
+        """wait until the writer thread wrote everything that was received so far"""
+        if self.writer is not None:
+            self.writer.wait()
+
+    def _save_checkpoint(self, f, state_path: str, file_headers: dict, start: int, offset: int, digest: str) -> str:
+        """make sure the first `offset` bytes of a partial file are on disk and save where to continue. Returns the new hash"""
+        f.flush()
+        os.fsync(f.fileno())
+        # The segment was just written, so hashing it reads from the page cache
+        digest = sync_shared.chain_hash(digest, f, start, offset)
+        f.seek(offset)
+
+        state = {
+            "path": file_headers["path"],
+            "file-length": file_headers["file-length"],
+            "mtime": file_headers.get("mtime"),
+            "offset": offset,
+            "hash": digest
+        }
+        with open(state_path + ".tmp", 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(state_path + ".tmp", state_path)
+        return digest
+
+    def _load_partial_state(self, state_path: str) -> dict | None:
+        try:
+            with open(state_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _get_partial_paths(self, relative_path: str) -> tuple[str, str]:
+        """get the paths of the partial file and its saved state while a file is received"""
+        name = hashlib.sha256(relative_path.encode(sync_shared.FORMAT)).hexdigest()
+        directory = os.path.join(self.output_path, sync_shared.METADATA_DIRECTORY, PARTIAL_DIRECTORY)
+        return (os.path.join(directory, name), os.path.join(directory, name + ".json"))
+
+    def _handle_delta(self, conn: socket.socket, delta_headers: dict):
+        """rebuild a file from the blocks of the current copy and the literal data sent by the client"""
+
+        try:
+            path = self._resolve_path(delta_headers["path"])
+        except ValueError as e:
+            self.receiver.discard(delta_headers["delta-length"])
+            self._is_stale(delta_headers)
+            self._acknowledge(conn, delta_headers, e)
+            return
+        # The file is rebuilt next to the partial files and moved into place when it's complete
+        temp_path = self._get_partial_paths(delta_headers["path"])[0] + ".delta"
+        with self.server.path_locks.lock(path):
+            basis = None
+            try:
+                basis = open(path, 'rb')
+                os.makedirs(os.path.dirname(temp_path), exist_ok=True)
+                output = open(temp_path, 'wb')
+            except OSError as e:
+                # The old copy is gone, skip the delta so the client sends the whole file
+                if basis is not None:
+                    basis.close()
+                self.receiver.discard(delta_headers["delta-length"])
+                self._is_stale(delta_headers)
+                self._acknowledge(conn, delta_headers, e)
+                return
+            with basis, output:
+                sync_shared.apply_delta(self.receiver, delta_headers["delta-length"], basis, delta_headers["block-size"], output)
+
+            if self._is_stale(delta_headers):
+                os.remove(temp_path)
+                self._acknowledge(conn, delta_headers)
+                return
+
+            try:
+                # The copy on the server can change between the signature and the delta, then the rebuilt file is wrong
+                # and the client sends the whole file instead
+                if os.path.getsize(temp_path) != delta_headers["file-length"] or \
+                        ("hash" in delta_headers and sync_shared.hash_file(temp_path) != delta_headers["hash"]):
+                    os.remove(temp_path)
+                    raise ValueError(f"The delta of '{delta_headers['path']}' doesn't match, the file changed since its signature")
+                target = self._resolve_conflict(path, delta_headers)
+                os.replace(temp_path, target)
+                mtime = delta_headers.get("mtime")
+                if mtime is not None:
+                    os.utime(target, ns=(mtime, mtime))
+                self._store_hash(target, delta_headers)
+                self.server.record_applied(self, path, target)
+            except (OSError, ValueError) as e:
+                self._acknowledge(conn, delta_headers, e)
+                return
+
+        sync_shared.done(f"Patched '{delta_headers['path']}' with a delta of {delta_headers['delta-length']} bytes")
+        sync_shared.metrics.inc("sync_server_bytes_received_total", delta_headers["delta-length"], kind="delta")
+        sync_shared.metrics.inc("sync_server_files_received_total", kind="delta")
+        self._acknowledge_synced(conn, delta_headers, [target])
+
+    def _handle_bundle(self, conn: socket.socket, payload: bytes):
+        """unpack the directories and small files of a bundle in one pass"""
+        (bundle_headers, entries) = sync_shared.decode_bundle(payload)
+        try:
+            (files, created) = self._unpack_bundle(entries)
+        except (OSError, ValueError) as e:
+            self._acknowledge(conn, bundle_headers, e)
+            return
+
+        sync_shared.done(f"Unpacked a bundle of {len(files)} files ({sync_shared.format_size(len(payload))})")
+        sync_shared.metrics.inc("sync_server_bytes_received_total", len(payload), kind="bundle")
+        sync_shared.metrics.inc("sync_server_files_received_total", len(files), kind="bundle")
+        self._acknowledge_synced(conn, bundle_headers, files + created)
+
+    def _unpack_bundle(self, entries) -> tuple[list, list]:
+        """write the entries of a bundle and return the paths of the written files and of the created directories"""
+        # Refuse the whole bundle before anything is written if one of the paths is outside the output directory
+        entries = [(entry, data, self._resolve_path(entry["path"])) for (entry, data) in entries]
+        # Only create every parent directory once per bundle
+        directories = set()
+        (files, created) = ([], [])
+        # The files are written next to the partial files and moved into place, so a crash never leaves a truncated file
+        os.makedirs(os.path.join(self.output_path, sync_shared.METADATA_DIRECTORY, PARTIAL_DIRECTORY), exist_ok=True)
+        for (entry, data, path) in entries:
+            if entry.get("directory"):
+                os.makedirs(path, exist_ok=True)
+                directories.add(path)
+                created.append(path)
+                self.server.record_applied(self, path)
+                continue
+
+            parent = os.path.dirname(path)
+            if parent not in directories:
+                os.makedirs(parent, exist_ok=True)
+                directories.add(parent)
+            with self.server.path_locks.lock(path):
+                target = self._resolve_conflict(path, entry)
+                temp_path = self._get_partial_paths(entry["path"])[0] + ".bundle"
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                mtime = entry.get("mtime")
+                if mtime is not None:
+                    os.utime(temp_path, ns=(mtime, mtime))
+                os.replace(temp_path, target)
+                self.server.record_applied(self, path, target)
+            files.append(target)
+        return (files, created)
+
+    def _store_hash(self, path: str, headers: dict):
+        """remember the hash the client sent for the contents of a file, so later files with the same contents don't have to be sent"""
+        if "hash" in headers:
+            self.server.hashes.store(path, os.stat(path), headers["hash"])
+
+    def _break_link(self, path: str):
+        """remove a hard link before the file is written in place, so the other files with the same contents stay the same"""
+        if self.server.hardlinks:
+            try:
+                if os.stat(path).st_nlink > 1:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _resolve_conflict(self, path: str, headers: dict) -> str:
+        """get the path to write contents from the client to. When the file also changed on the server since the client
+        last sent it, the newest version keeps the path and the other one is kept next to it. Returns the path to write to"""
+        # Data streams and the lane of a bidirectional client don't get pushes, so only the headers tell
+        if not self.server.bidirectional or "base" not in headers:
+            return path
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return path
+        if not S_ISREG(stat.st_mode) or self.server.hashes.hash_file(path, stat) in (headers["base"], headers.get("hash")):
+            return path
+
+        sync_shared.metrics.inc("sync_server_conflicts_total")
+        relative_path = self._get_relative_path(path)
+        # Ties go to the server, the client decides the same way when it receives the version of the server
+        if headers.get("mtime", 0) > stat.st_mtime_ns:
+            conflict = sync_shared.conflict_path(path, "server")
+            copy2(path, conflict)
+            # Rare enough to fsync right away, the path it was copied from is replaced next
+            if self.server.fsync != "none":
+                _fsync_path(conflict)
+            sync_shared.warn(f"'{relative_path}' changed on both sides, the version of the server is kept as '{self._get_relative_path(conflict)}'")
+            return path
+
+        conflict = sync_shared.conflict_path(path, self.name)
+        sync_shared.warn(f"'{relative_path}' changed on both sides, the version of '{self.name}' is kept as '{self._get_relative_path(conflict)}'")
+        # The client still has its own version at the path
+        self.server.pushes.put(("file", path))
+        return conflict
+
+    def _handle_event(self, conn: socket.socket, event_headers: dict):
+        """handle all content-type: 'event' messages from the client"""
+
+        relative_source = event_headers.get("source-path")
+        try:
+            if relative_source is not None:
+                event_headers["source-path"] = self._resolve_path(relative_source)
+            if "destination-path" in event_headers:
+                event_headers["destination-path"] = self._resolve_path(event_headers["destination-path"])
+            # Clients that share the output directory take turns on the same path
+            paths = [event_headers.get("source-path", self.output_path)]
+            if "destination-path" in event_headers:
+                paths.append(event_headers["destination-path"])
+            with self.server.path_locks.lock(*paths):
+                written = self._apply_event(conn, event_headers, relative_source)
         except Exception as e:
-            # Ignore errors for now
             sync_shared.fail(f"Failed to process '{event_headers['event-type']}' event with error:")
             sync_shared.fail(str(e))
-            pass
+            if "seq" not in event_headers:
+                # A request gets a reply instead of an acknowledgement, the client is waiting for it
+                self._send({"event-type": event_headers["event-type"], "error": str(e)}, "reply")
+            self._acknowledge(conn, event_headers, e)
+            return
+        self._acknowledge_synced(conn, event_headers, written or [])
+
+    def _acknowledge_synced(self, conn: socket.socket, headers: dict, paths: list):
+        """acknowledge an operation once the paths it changed are durable according to the fsync policy"""
+        def on_synced(error: Exception | None):
+            if self.closed:
+                return
+            # Runs on the thread that fsyncs for every connection, so nothing may escape
+            try:
+                self._acknowledge(conn, headers, error)
+            except (Exception, SystemExit) as e:
+                # The client sends the operation again after it reconnects. A failed send logged its error already
+                if not self.closed:
+                    reason = "" if isinstance(e, SystemExit) else f": {e}"
+                    sync_shared.fail(f"Could not acknowledge an operation of '{self.name}', closing the connection{reason}")
+                    self.close()
+        self.server.syncer.submit(paths, on_synced)
+
+    def _acknowledge(self, conn: socket.socket, headers: dict, error: Exception = None):
+        """let the client know if an operation was applied, requests that get a reply have no sequence number"""
+        seq = headers.get("seq")
+        if seq is None:
+            return
+        if error is None:
+            self._send({"seq": seq, "ok": True}, "ack")
+        else:
+            sync_shared.fail(f"Could not apply operation {seq}: {error}")
+            sync_shared.metrics.inc("sync_server_nacks_total")
+            self._send({"seq": seq, "ok": False, "error": str(error)}, "ack")
+
+    def _apply_event(self, conn: socket.socket, event_headers: dict, relative_source: str | None) -> list | None:
+        """apply a single event to the output directory. Returns the paths it changed, which are fsynced before the event
+        is acknowledged"""
+        if event_headers["event-type"] == "created":
+            if event_headers["directory"]:
+                # A move into the directory can have created it already
+                os.makedirs(event_headers["source-path"], exist_ok=True)
+            else:
+                self._break_link(event_headers["source-path"])
+                f = open(event_headers["source-path"], 'wb')
+                f.close()
+            self.server.record_applied(self, event_headers["source-path"])
+            
+            sync_shared.done(f"Created { 'directory' if event_headers['directory'] else 'file' } '{relative_source}'")
+            return [event_headers["source-path"]]
+        elif event_headers["event-type"] == "clear":
+            self._break_link(event_headers["source-path"])
+            f = open(event_headers["source-path"], 'wb')
+            f.close()
+            self.server.record_applied(self, event_headers["source-path"])
+
+            sync_shared.done(f"Cleared file '{relative_source}'")
+            return [event_headers["source-path"]]
+        elif event_headers["event-type"] == "deleted":
+            # Try to delete path as a file, if that errors it must be a directory.
+            # This workaround is needed, because watchdog can't determine wether a deleted path was a directory or not
+            try:
+                os.remove(event_headers["source-path"])
+            except:
+                rmtree(event_headers["source-path"], True)
+            self.server.record_applied(self, event_headers["source-path"])
+
+            sync_shared.done(f"Deleted '{relative_source}'")
+            return [event_headers["source-path"]]
+        elif event_headers["event-type"] == "moved":
+            source = event_headers["source-path"]
+            destination = event_headers["destination-path"]
+            # A bidirectional client also reports the moves it got from the server
+            if not os.path.lexists(source) and os.path.lexists(destination):
+                return
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            # A directory can only be replaced by an empty directory
+            if os.path.isdir(destination) and not os.path.islink(destination):
+                rmtree(destination, True)
+            os.replace(source, destination)
+            self.server.hashes.move(source, destination)
+            self.server.record_applied(self, source)
+
+            sync_shared.done(f"Moved '{relative_source}' to '{self._get_relative_path(destination)}'")
+            return [destination, source]
+        elif event_headers["event-type"] == "signature":
+            # Send the block checksums of the current copy so the client can send a delta
+            try:
+                signature = sync_shared.compute_signature(event_headers["source-path"])
+            except OSError:
+                # There is no copy to compare with so the client sends the whole file
+                signature = {"blocks": []}
+            self._send(json.dumps(signature), "signature", codec=self.codec)
+        elif event_headers["event-type"] == "resume":
+            # Tell the client where a broken off transfer of the same file can continue
+            state = self._load_partial_state(self._get_partial_paths(relative_source)[1])
+            if state is not None and state["file-length"] == event_headers.get("file-length") and state["mtime"] == event_headers.get("mtime"):
+                self._send({"event-type": "resume", "offset": state["offset"], "hash": state["hash"]}, "reply")
+            else:
+                self._send({"event-type": "resume", "offset": 0}, "reply")
+        elif event_headers["event-type"] == "pull":
+            # Send a path the client doesn't have, the acknowledgement follows after it
+            source = event_headers["source-path"]
+            if os.path.isdir(source):
+                self.push(("directory", source))
+                for root, dirs, files in os.walk(source):
+                    for name in dirs:
+                        self.push(("directory", os.path.join(root, name)))
+                    for name in files:
+                        self.push(("file", os.path.join(root, name)))
+            else:
+                self.push(("file", source))
+        elif event_headers["event-type"] == "have":
+            # Tell the client which of the contents it is about to send are somewhere in the output directory already
+            hashes = [digest for digest in event_headers["hashes"].split(",") if self.server.hashes.find(digest, self.output_path) is not None]
+            self._send({"event-type": "have", "hashes": ",".join(hashes)}, "reply")
+        elif event_headers["event-type"] == "link":
+            # Make the file from contents the server has instead of receiving them
+            path = event_headers["source-path"]
+            source = self.server.hashes.find(event_headers["hash"], self.output_path)
+            if source is None:
+                raise FileNotFoundError(f"There is no file with the contents of '{relative_source}' anymore")
+            target = self._resolve_conflict(path, event_headers)
+            # The copy is made next to the partial files and moved into place when it's complete
+            link_path = self._get_partial_paths(relative_source)[0] + ".link"
+            os.makedirs(os.path.dirname(link_path), exist_ok=True)
+            if os.path.exists(link_path):
+                os.remove(link_path)
+            method = sync_shared.clone_file(source, link_path, self.server.hardlinks)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(link_path, target)
+            # A hard link shares the mtime with the source
+            if method != "hardlink":
+                os.utime(target, ns=(event_headers["mtime"], event_headers["mtime"]))
+            self._store_hash(target, event_headers)
+            self.server.record_applied(self, path, target)
+
+            size = os.path.getsize(target)
+            sync_shared.metrics.inc("sync_server_deduplicated_total", method=method)
+            sync_shared.metrics.inc("sync_server_deduplicated_bytes_total", size)
+            sync_shared.done(f"Made '{relative_source}' from '{self._get_relative_path(source)}' with a {method} ({sync_shared.format_size(size)})")
+            return [target]
+        elif event_headers["event-type"] == "barrier":
+            # Every event before this one is applied, let the client know
+            self._send({"event-type": "barrier"}, "reply")
+        elif event_headers["event-type"] == "manifest":
+            # Send the current file tree back so the client only has to send the difference
+            sync_shared.info("Sending manifest of the file tree...")
+
+            os.makedirs(self.output_path, exist_ok=True)
+            manifest = self._build_manifest()
+            self._send(json.dumps(manifest), "manifest", codec=self.codec)
+        else:
+            raise ValueError(f"Unknown event type '{event_headers['event-type']}'")
+
+    def push(self, change: tuple):
+        """send a change in the output directory to the client: ("file", path), ("directory", path), ("deleted", path)
+        or ("moved", source, destination)"""
+        (kind, path) = change[:2]
+        if not path.startswith(self.output_path + os.sep):
+            return
+        relative_path = self._get_relative_path(path)
+
+        if kind == "file":
+            try:
+                f = open(path, 'rb')
+            except OSError:
+                # Gone again already
+                return
+            with f, self.send_lock:
+                stat = os.fstat(f.fileno())
+                if not S_ISREG(stat.st_mode):
+                    return
+                sync_shared.send(self.connection, {"path": relative_path, "file-length": stat.st_size, "mtime": stat.st_mtime_ns}, "file")
+                sync_shared.send_file_contents(self.connection, f, stat.st_size)
+            sync_shared.info(f"Sent '{relative_path}' to '{self.name}'")
+        elif kind == "moved":
+            destination = change[2]
+            if not destination.startswith(self.output_path + os.sep):
+                return
+            self._send({"event-type": "moved", "source-path": relative_path, "destination-path": self._get_relative_path(destination)}, "event")
+        elif kind == "directory":
+            self._send({"event-type": "created", "directory": True, "source-path": relative_path}, "event")
+        else:
+            self._send({"event-type": "deleted", "source-path": relative_path}, "event")
+        sync_shared.metrics.inc("sync_server_pushes_total", kind=kind)
+
+    def _build_manifest(self) -> list:
+        """describe every path in the output directory with its size and mtime. Files aren't read for it, so only the
+        hashes that are known already are included, the client only needs them when the mtimes differ. The other files
+        are hashed in the background"""
+        manifest = []
+        unhashed = []
+        # Partial transfers are not part of the tree
+        prune = lambda relative_path, entry: relative_path == sync_shared.METADATA_DIRECTORY
+        for (relative_path, entry) in sync_shared.scan_tree(self.output_path, prune):
+            if entry.is_dir():
+                manifest.append({
+                    "path": relative_path,
+                    "directory": True
+                })
+                continue
+            stat = entry.stat()
+            file_entry = {
+                "path": relative_path,
+                "directory": False,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns
+            }
+            digest = self.server.hashes.get(entry.path, stat)
+            if digest is not None:
+                file_entry["hash"] = digest
+            else:
+                unhashed.append((entry.path, stat))
+            manifest.append(file_entry)
+        self.server.hashes.hash_later(unhashed)
+        return manifest
+
+    def _resolve_path(self, relative_path: str) -> str:
+        """get the path in the output directory of a path sent by the client. Paths that end up outside the output
+        directory, at the output directory itself or in its metadata directory are refused"""
+        path = os.path.normpath(os.path.join(self.output_path, relative_path))
+        if path == self.output_path or os.path.commonpath([self.output_path, path]) != self.output_path:
+            raise ValueError(f"Refused '{relative_path}', it is outside the output directory")
+        relative = os.path.relpath(path, self.output_path)
+        if relative == sync_shared.METADATA_DIRECTORY or relative.startswith(sync_shared.METADATA_DIRECTORY + os.sep):
+            raise ValueError(f"Refused '{relative_path}', it is in the metadata directory")
+        return path
+
+    def _get_relative_path(self, path: str) -> str:
+        """get the relative path from the output directory"""
+        return os.path.relpath(path, self.output_path).replace('\\', '/')
 
 
 def main():
@@ -219,6 +1216,10 @@ def main():
         server.listen()
 
         sync_shared.info(f"Outputting to directory {socket_handler.output_path}")
+        if socket_handler.bidirectional:
+            socket_handler.watch()
+        if socket_handler.metrics_port is not None:
+            sync_shared.serve_metrics(socket_handler.host, socket_handler.metrics_port)
         sync_shared.info(f"Listening on {socket_handler.host}:{socket_handler.port}")
     except server.error as msg:
         sync_shared.fail("Couldn not open socket.")
@@ -227,9 +1228,8 @@ def main():
 
     socket_handler._socket = server
     with server:
-        # start listening to the socket
-        socket_handler.start()
-        pass
+        # accept connections until the server is stopped (ctrl+c)
+        socket_handler.serve()
     
 if __name__ == "__main__":
     main()
@@ -1,79 +1,1190 @@
-from rich.console import Console
 from time import strftime
-import socket
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+import errno
+import hashlib
 import json
+import logging
+import lzma
+import math
+import os
+import re
+import shutil
+import socket
+import struct
 import sys
+import time
+import zlib
+
+# fcntl is only available on unix systems
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-# maximum transition unit in bytes (maximum buffer size socket connection)
-MTU = 4096
-# Fix the header size to 128 bytes
-HEADER_SIZE = 128
+# Faster compression codecs are used when they are installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Default size of the reusable receive buffer, can be changed with --buffer-size
+BUFFER_SIZE = 1024 * 1024
+# Maximum amount of bytes handed to the kernel per sendfile/splice call, so progress can be reported in between
+SENDFILE_CHUNK_SIZE = 8 * 1024 * 1024
+# Maximum amount of bytes sent at once when the sender is throttled, so other traffic can go in between
+THROTTLE_CHUNK_SIZE = 256 * 1024
+# Errors of sendfile/splice that mean the kernel can't do it for these file descriptors, so the buffered loop is used instead
+ZERO_COPY_ERRORS = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSOCK, errno.EBADF)
+# Version of the wire protocol, both sides have to use the same version
+PROTOCOL_VERSION = 9
+# Every frame starts with the content type, flags and the length of the payload
+FRAME_HEADER = struct.Struct('>BBI')
+# Content types and their id in the frame header
+CONTENT_TYPES = {
+    "message": 0,
+    "hello": 1,
+    "event": 2,
+    "file": 3,
+    "delta": 4,
+    "manifest": 5,
+    "signature": 6,
+    "reply": 7,
+    "bundle": 8,
+    "ack": 9,
+    "trailer": 10
+}
+CONTENT_TYPE_NAMES = {value: key for (key, value) in CONTENT_TYPES.items()}
+# Type tags of encoded field values
+FIELD_NONE = 0
+FIELD_FALSE = 1
+FIELD_TRUE = 2
+FIELD_INT = 3
+FIELD_STR = 4
+FIELD_BYTES = 5
 # Binary encoding format
 FORMAT = 'utf-8'
 # The disconnect message
 DISCONNECT_MESSAGE = "!DISCONNECT"
+# Directory inside the synced directory that holds the index and other metadata, it is never synced itself
+METADATA_DIRECTORY = '.sync_files'
+# Hash algorithm used to compare file contents between client and server
+HASH_ALGORITHM = 'sha256'
+# Read size used when hashing files
+HASH_BUFFER_SIZE = 1024 * 1024
+# Files smaller than this are always sent as a whole instead of as a delta
+DELTA_THRESHOLD = 256 * 1024
+# Bounds for the block size of delta signatures, the actual size grows with the square root of the file size
+DELTA_MIN_BLOCK_SIZE = 2048
+DELTA_MAX_BLOCK_SIZE = 128 * 1024
+# Give up on a delta when this many bytes are scanned without finding a matching block
+DELTA_MAX_SCAN = 8 * 1024 * 1024
+# Bytes of the new file that are read at once while looking for matching blocks
+DELTA_WINDOW_SIZE = 8 * 1024 * 1024
+# Delta instructions: copy a range of blocks from the old file or insert literal data
+DELTA_COPY = b'C'
+DELTA_LITERAL = b'L'
+DELTA_COPY_FORMAT = struct.Struct('>QI')
+DELTA_LITERAL_FORMAT = struct.Struct('>I')
+# The modulus of the adler32 checksum that is used as the rolling checksum
+ADLER_MOD = 65521
+
+# Files smaller than this are packed into bundles together with the directories they need
+BUNDLE_FILE_SIZE = 64 * 1024
+# A bundle is sent once its contents reach this size, so it still fits in the default receive buffer
+BUNDLE_MAX_SIZE = 1024 * 1024 - 64 * 1024
+# Received files are saved every this many bytes, so a transfer that breaks off can continue from there
+RESUME_CHECKPOINT = 64 * 1024 * 1024
+# Set in the frame header when the payload starts with a codec id and is compressed
+FLAG_COMPRESSED = 0x01
+# Frames smaller than this are never compressed
+COMPRESSION_MIN_SIZE = 1024
+# Files are compressed in chunks of this size, so both sides only hold one chunk in memory
+COMPRESSION_CHUNK_SIZE = 256 * 1024
+# Every compressed chunk starts with its length on the wire and its length after decompressing
+COMPRESSION_CHUNK_HEADER = struct.Struct('>II')
+# Amount of bytes at the start of a file used to estimate if it compresses at all
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+# Samples with more bits of entropy per byte than this are already compressed or random
+COMPRESSION_MAX_ENTROPY = 7.5
+# Stop compressing a file after this many chunks in a row didn't get smaller by a tenth
+COMPRESSION_MAX_MISSES = 4
+# Extensions of files that are compressed already
+COMPRESSED_EXTENSIONS = {
+    ".7z", ".avi", ".br", ".bz2", ".docx", ".gif", ".gz", ".jar", ".jpeg", ".jpg", ".lz4", ".mkv", ".mov", ".mp3",
+    ".mp4", ".ogg", ".pdf", ".png", ".pptx", ".rar", ".tgz", ".webm", ".webp", ".whl", ".xlsx", ".xz", ".zip", ".zst"
+}
+
+# Upper bounds in seconds of the histogram buckets
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Default amount of threads that read directories at the same time while a tree is scanned
+SCAN_WORKERS = 8
+# Entries of a directory are handed over in chunks of this size
+SCAN_CHUNK_SIZE = 1024
+# Chunks a scan can be ahead of the code that uses them
+SCAN_QUEUE_SIZE = 64
+
+# ioctl that makes a file share the blocks of another file on filesystems like btrfs and xfs (linux only)
+FICLONE = 0x40049409
+
+# Characters that are allowed in the name of a client when it is used in a path
+NAME_PATTERN = re.compile(r'[^A-Za-z0-9._-]')
+
+# Ways to write log messages: colors and progress bars in a terminal, standard logging lines or JSON lines
+LOG_FORMATS = ("rich", "plain", "json")
+# Info and done messages logged per second without rich, the rest is counted and reported once
+LOG_RATE_LIMIT = 20
+# Seconds between the log lines that show the progress of a transfer without rich
+PROGRESS_LOG_INTERVAL = 5
+# Transfers smaller than this don't get their own progress bar
+PROGRESS_MIN_SIZE = 8 * 1024 * 1024
 
 # Ansi color codes
 C_RESET = '\u001b[0m'
 C_WHITE = '\u001b[37m'
 
-# The global rich.Console instance
-console = Console()
+# Compression codecs in order of preference: name -> (id on the wire, compress, decompress)
+CODECS = {}
+if zstandard is not None:
+    CODECS["zstd"] = (3, lambda data: zstandard.ZstdCompressor(level=3).compress(data), lambda data: zstandard.ZstdDecompressor().decompress(data))
+if lz4 is not None:
+    CODECS["lz4"] = (4, lambda data: lz4.frame.compress(data), lz4.frame.decompress)
+CODECS["zlib"] = (1, lambda data: zlib.compress(data, 1), zlib.decompress)
+CODECS["lzma"] = (2, lambda data: lzma.compress(data, preset=1), lzma.decompress)
+CODEC_NAMES = {codec[0]: name for (name, codec) in CODECS.items()}
 
 # Logging
 
+# One of LOG_FORMATS, set with `set_log_format`
+log_format = "rich"
+# The global rich.Console instance, rich is only imported once it is used
+_console = None
+_logger = logging.getLogger("sync_files")
+_log_lock = Lock()
+# Start of the current second, messages logged in it and messages that were suppressed
+_log_window = [0.0, 0, 0]
+
+def get_console():
+    global _console
+    if _console is None:
+        from rich.console import Console
+        _console = Console()
+    return _console
+
+class JsonFormatter(logging.Formatter):
+    """formats a log record as a single JSON line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps({"time": record.created, "level": record.levelname.lower(), "message": record.getMessage()})
+
+def set_log_format(name: str):
+    """write log messages as rich, plain or json. "auto" uses rich only when the output is a terminal"""
+    global log_format
+    if name == "auto":
+        name = "rich" if sys.stdout.isatty() else "plain"
+    log_format = name
+    if name == "rich":
+        return
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if name == "json" else logging.Formatter("[%(asctime)s] %(levelname)s %(message)s", "%X"))
+    _logger.handlers = [handler]
+    _logger.setLevel(logging.INFO)
+    _logger.propagate = False
+
 def log_time():
     # Make text dim white with C_WHITE
     print(f'{C_WHITE}[{strftime("%X")}]{C_RESET}', end='')
 
 def info(message: str):
-    print()
-    log_time()
-    console.print(f" [bold #000000 on #57c7ff] INFO [/bold #000000 on #57c7ff] [#57c7ff]{message}[/#57c7ff]")
-    
+    _log(logging.INFO, "INFO", "#57c7ff", message)
 
 def done(message: str):
-    print()
-    log_time()
-    console.print(f" [bold #000000 on #5af78e] DONE [/bold #000000 on #5af78e] [#5af78e]{message}[/#5af78e]")
+    _log(logging.INFO, "DONE", "#5af78e", message)
 
 def warn(message: str):
-    print()
-    log_time()
-    console.print(f" [bold #000000 on #f3f99d] WARN [/bold #000000 on #f3f99d] [#f3f99d]{message}[/#f3f99d]")
+    _log(logging.WARNING, "WARN", "#f3f99d", message)
 
 def fail(message: str):
-    print()
-    log_time()
-    console.print(f" [bold #000000 on #ff5c57] FAIL [/bold #000000 on #ff5c57] [#ff5c57]{message}[/#ff5c57]")
+    _log(logging.ERROR, "FAIL", "#ff5c57", message)
+
+def _log(level: int, label: str, color: str, message: str):
+    if log_format == "rich":
+        print()
+        log_time()
+        get_console().print(f" [bold #000000 on {color}] {label} [/bold #000000 on {color}] [{color}]{message}[/{color}]")
+        return
+
+    # Thousands of small files would flood the log, warnings and failures always get through
+    if level < logging.WARNING and not _take_log_slot():
+        return
+    _logger.log(level, message)
+
+def _take_log_slot() -> bool:
+    with _log_lock:
+        now = time.monotonic()
+        if now - _log_window[0] >= 1:
+            suppressed = _log_window[2]
+            _log_window[:] = [now, 0, 0]
+            if suppressed:
+                _logger.info(f"{suppressed} messages were suppressed")
+        if _log_window[1] >= LOG_RATE_LIMIT:
+            _log_window[2] += 1
+            return False
+        _log_window[1] += 1
+        return True
+
+class ProgressView:
+    """shows the progress of a transfer or a batch of files. With rich this is a progress bar, otherwise a log line
+    every PROGRESS_LOG_INTERVAL seconds. Hidden views only count, so small transfers don't pay for a live display"""
+
+    def __init__(self, description: str, total: int, completed: int = 0, unit: str = "bytes", show: bool = True):
+        self.description = description
+        self.total = total
+        self.completed = completed
+        self.unit = unit
+        self.show = show
+        self._lock = Lock()
+        self._progress = None
+        self._last_log = 0.0
+
+    def __enter__(self) -> 'ProgressView':
+        if self.show and log_format == "rich":
+            import rich.progress
+            if self.unit == "bytes":
+                columns = (rich.progress.FileSizeColumn(), rich.progress.TotalFileSizeColumn())
+            else:
+                columns = (rich.progress.MofNCompleteColumn(),)
+            self._progress = rich.progress.Progress(
+                rich.progress.TextColumn("{task.description}"),
+                rich.progress.BarColumn(),
+                *columns,
+                rich.progress.TimeRemainingColumn(),
+                console=get_console()
+            )
+            self._progress.start()
+            self._task = self._progress.add_task(self.description, total=self.total, completed=self.completed)
+        self._last_log = time.monotonic()
+        return self
+
+    def advance(self, count: int):
+        with self._lock:
+            self.completed += count
+            if self._progress is not None:
+                self._progress.update(self._task, advance=count)
+            elif self.show and time.monotonic() - self._last_log >= PROGRESS_LOG_INTERVAL:
+                self._last_log = time.monotonic()
+                info(f"{self.description} {self._format(self.completed)} of {self._format(self.total)}")
+
+    def __exit__(self, *exc_info):
+        if self._progress is not None:
+            self._progress.stop()
+
+    def _format(self, count: int) -> str:
+        return format_size(count) if self.unit == "bytes" else f"{count} {self.unit}"
+
+
+# Metrics
+
+class Metrics:
+    """counters, gauges and histograms that are rendered in the Prometheus text format.
+    Hooks are called with every change, so the values can be forwarded to another metrics system as well"""
+
+    def __init__(self):
+        self._lock = Lock()
+        # name -> [type, help, {labels: value}], the value of a histogram is [bucket counts, sum, count]
+        self._metrics = {}
+        # Callables that get the name, type, value and labels of every change
+        self.hooks = []
+
+    def describe(self, name: str, metric_type: str, help: str):
+        with self._lock:
+            self._metrics.setdefault(name, [metric_type, help, {}])
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """add to a counter or gauge"""
+        with self._lock:
+            values = self._metrics[name][2]
+            key = tuple(sorted(labels.items()))
+            values[key] = values.get(key, 0) + value
+        self._call_hooks(name, value, labels)
+
+    def set(self, name: str, value: float, **labels):
+        """set a gauge"""
+        with self._lock:
+            self._metrics[name][2][tuple(sorted(labels.items()))] = value
+        self._call_hooks(name, value, labels)
+
+    def observe(self, name: str, value: float, **labels):
+        """add a sample to a histogram"""
+        with self._lock:
+            values = self._metrics[name][2]
+            key = tuple(sorted(labels.items()))
+            histogram = values.setdefault(key, [[0] * len(METRICS_BUCKETS), 0.0, 0])
+            for (index, bound) in enumerate(METRICS_BUCKETS):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+        self._call_hooks(name, value, labels)
+
+    def render(self) -> str:
+        """render every metric in the Prometheus text format"""
+        lines = []
+        with self._lock:
+            for (name, (metric_type, help, values)) in self._metrics.items():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for (key, value) in values.items():
+                    if metric_type != "histogram":
+                        lines.append(f"{name}{_format_labels(key)} {value}")
+                        continue
+                    (buckets, total, count) = value
+                    for (bound, bucket) in zip(METRICS_BUCKETS, buckets):
+                        lines.append(f"{name}_bucket{_format_labels(key + (('le', str(bound)),))} {bucket}")
+                    lines.append(f"{name}_bucket{_format_labels(key + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {total}")
+                    lines.append(f"{name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def _call_hooks(self, name: str, value: float, labels: dict):
+        for hook in self.hooks:
+            hook(name, self._metrics[name][0], value, labels)
+
+def _format_labels(key: tuple) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{label}="{value}"' for (label, value) in key) + "}"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """answers GET /metrics with the current metrics"""
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode(FORMAT)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        # Scrapes would fill up the console
+        pass
+
+def serve_metrics(host: str, port: int):
+    """serve the metrics over http from a background thread"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    info(f"Serving metrics on http://{host}:{port}/metrics")
+
+# The metrics of this process
+metrics = Metrics()
 
 
 # Socket stuff
 
-def send(socket: socket.socket, message: str, content_type="message"):
-    """send a message from a socket"""
+def send(socket: socket.socket, message: str | bytes | dict, content_type="message", flags=0, codec: str = None):
+    """send a message from a socket. Dictionaries are sent as encoded fields, large messages are compressed with `codec`"""
     try:
-        # encode message to bytes if not already done
-        if type(message) != bytes:
-            message = message.encode(FORMAT)
-
-        # Prepare the header
-        send_length = len(message)
-        headers = {
-            "content-type": content_type,
-            "content-length": send_length
-        }
-        header_string = json.dumps(headers).encode(FORMAT)
-        header_string += b' ' * (HEADER_SIZE - len(header_string))
-
-        # First send the header then the actual message
-        socket.send(header_string)
-        socket.send(message)
-    except socket.error as msg:
+        # Send the frame header and the message at once
+        socket.sendall(encode_frame(message, content_type, flags, codec))
+    except OSError as msg:
         fail("Could not send message.")
         fail(msg)
         sys.exit(1)
 
+def encode_frame(message: str | bytes | dict, content_type="message", flags=0, codec: str = None) -> bytes:
+    """encode a message with its frame header"""
+    # encode message to bytes if not already done
+    if type(message) == dict:
+        message = encode_fields(message)
+    elif type(message) != bytes:
+        message = message.encode(FORMAT)
+
+    if codec is not None and len(message) >= COMPRESSION_MIN_SIZE:
+        (codec_id, compress, _) = CODECS[codec]
+        compressed = compress(message)
+        if len(compressed) < len(message):
+            message = bytes([codec_id]) + compressed
+            flags |= FLAG_COMPRESSED
+    return FRAME_HEADER.pack(CONTENT_TYPES[content_type], flags, len(message)) + message
+
+def receive_frame(receiver: 'Receiver') -> tuple[str, int, bytes]:
+    """receive the next frame and return its content type, flags and payload"""
+    (content_type, flags, length) = FRAME_HEADER.unpack(receiver.recv_exactly(FRAME_HEADER.size))
+    if content_type not in CONTENT_TYPE_NAMES:
+        raise ValueError(f"Unknown content type {content_type}")
+    payload = bytes(receiver.recv_exactly(length))
+    if flags & FLAG_COMPRESSED:
+        payload = get_codec(payload[0])[2](payload[1:])
+    return (CONTENT_TYPE_NAMES[content_type], flags, payload)
+
+def send_file_contents(socket: socket.socket, f, length: int, on_progress=None, start: int = 0, throttle=None, use_sendfile: bool = True) -> int:
+    """send exactly `length` bytes of an opened file from `start` on. The kernel copies the file straight to the socket
+    with sendfile when possible and `use_sendfile` is set, otherwise the file is read in buffer sized pieces. `throttle`
+    is called with the size of every piece before it's sent and can wait. Returns the amount of bytes read from the file"""
+    offset = 0
+    chunk_size = SENDFILE_CHUNK_SIZE if throttle is None else THROTTLE_CHUNK_SIZE
+    if use_sendfile and hasattr(os, "sendfile"):
+        try:
+            while offset < length:
+                if throttle is not None:
+                    throttle(min(length - offset, chunk_size))
+                count = os.sendfile(socket.fileno(), f.fileno(), start + offset, min(length - offset, chunk_size))
+                # The file is shorter than announced
+                if count == 0:
+                    break
+                offset += count
+                if on_progress is not None:
+                    on_progress(count)
+        except OSError as e:
+            # Only fall back when nothing is sent yet, otherwise it's a real socket error
+            if offset > 0 or e.errno not in ZERO_COPY_ERRORS:
+                raise
+        else:
+            return _send_padding(socket, offset, length)
+
+    buffer = bytearray(min(length, BUFFER_SIZE, chunk_size))
+    view = memoryview(buffer)
+    f.seek(start + offset)
+    while offset < length:
+        if throttle is not None:
+            throttle(min(length - offset, len(buffer)))
+        count = f.readinto(view[:min(length - offset, len(buffer))])
+        if not count:
+            break
+        socket.sendall(view[:count])
+        offset += count
+        if on_progress is not None:
+            on_progress(count)
+    return _send_padding(socket, offset, length)
+
+def _send_padding(socket: socket.socket, offset: int, length: int) -> int:
+    """fill up the rest of an announced length with zeros, so the receiver doesn't read into the next frame"""
+    if offset < length:
+        socket.sendall(bytes(length - offset))
+    return offset
+
+class Receiver:
+    """receives data from a socket into a single reusable buffer, so receiving doesn't allocate new bytes objects"""
+
+    def __init__(self, socket: socket.socket, buffer_size: int = BUFFER_SIZE, use_splice: bool = True):
+        self.socket = socket
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        # Pipe used to splice data from the socket to a file without copying it into python
+        self._pipe = None
+        self._use_splice = use_splice and hasattr(os, "splice")
+
+    def recv_exactly(self, length: int) -> memoryview:
+        """receive exactly `length` bytes. The returned view is only valid until the next call"""
+        # Messages that don't fit, like large manifests, get their own buffer so the reusable buffer stays small
+        view = self._view[:length] if length <= len(self._buffer) else memoryview(bytearray(length))
+
+        received = 0
+        while received < length:
+            count = self.socket.recv_into(view[received:], length - received)
+            # The connection was closed before everything was received
+            if count == 0:
+                raise ConnectionError("Connection closed while receiving data")
+            received += count
+        return view
+
+    def recv_into_file(self, f, length: int, on_progress=None, writer: 'FileWriter' = None):
+        """write the next `length` bytes of the socket directly to an opened file, or on the thread of `writer`"""
+        if writer is not None:
+            return self._recv_into_writer(f, length, on_progress, writer)
+        if self._use_splice:
+            length = self._splice_into_file(f, length, on_progress)
+
+        buffer_size = len(self._buffer)
+        while length > 0:
+            count = self.socket.recv_into(self._view[:min(length, buffer_size)])
+            if count == 0:
+                raise ConnectionError("Connection closed while receiving data")
+            f.write(self._view[:count])
+            length -= count
+            if on_progress is not None:
+                on_progress(count)
+
+    def recv_compressed_into_file(self, f, length: int, codec: str, on_progress=None, writer: 'FileWriter' = None) -> tuple[int, float]:
+        """write the next `length` bytes of a file that is sent as compressed chunks to an opened file, or on the thread
+        of `writer`. Returns the amount of bytes received and the cpu time spent decompressing"""
+        (_, _, decompress) = CODECS[codec]
+        received = 0
+        cpu_time = 0.0
+        while length > 0:
+            (compressed_length, size) = COMPRESSION_CHUNK_HEADER.unpack(self.recv_exactly(COMPRESSION_CHUNK_HEADER.size))
+            data = self.recv_exactly(compressed_length)
+            if compressed_length != size:
+                start = time.thread_time()
+                data = decompress(data)
+                cpu_time += time.thread_time() - start
+            if len(data) != size:
+                raise ValueError(f"Chunk decompressed to {len(data)} bytes instead of {size}")
+            if writer is not None:
+                # Uncompressed chunks are still a view of the receive buffer
+                writer.write(f, bytes(data))
+            else:
+                f.write(data)
+            length -= size
+            received += COMPRESSION_CHUNK_HEADER.size + compressed_length
+            if on_progress is not None:
+                on_progress(size)
+        return (received, cpu_time)
+
+    def _recv_into_writer(self, f, length: int, on_progress, writer: 'FileWriter'):
+        """fill the free buffers of `writer` from the socket and hand them over to be written"""
+        while length > 0:
+            buffer = writer.get_buffer()
+            size = min(length, len(buffer))
+            filled = 0
+            while filled < size:
+                count = self.socket.recv_into(buffer[filled:size], size - filled)
+                if count == 0:
+                    raise ConnectionError("Connection closed while receiving data")
+                filled += count
+                if on_progress is not None:
+                    on_progress(count)
+            writer.write(f, buffer[:size], buffer)
+            length -= size
+
+    def discard(self, length: int, codec: str = None):
+        """receive and throw away the next `length` bytes of a file, so the next frame can still be read"""
+        while length > 0:
+            if codec is None:
+                count = min(length, len(self._buffer))
+                self.recv_exactly(count)
+            else:
+                (compressed_length, count) = COMPRESSION_CHUNK_HEADER.unpack(self.recv_exactly(COMPRESSION_CHUNK_HEADER.size))
+                self.recv_exactly(compressed_length)
+            length -= count
+
+    def _splice_into_file(self, f, length: int, on_progress) -> int:
+        """move data from the socket to the file through a pipe inside the kernel. Returns the amount of bytes that are left"""
+        # Data that python still buffers has to be in the file first
+        f.flush()
+        if self._pipe is None:
+            self._pipe = os.pipe()
+            # A larger pipe means less splice calls per buffer
+            if fcntl is not None and hasattr(fcntl, "F_SETPIPE_SZ"):
+                try:
+                    fcntl.fcntl(self._pipe[1], fcntl.F_SETPIPE_SZ, len(self._buffer))
+                except OSError:
+                    pass
+        (pipe_out, pipe_in) = self._pipe
+        try:
+            while length > 0:
+                try:
+                    count = os.splice(self.socket.fileno(), pipe_in, min(length, SENDFILE_CHUNK_SIZE), flags=os.SPLICE_F_MOVE)
+                except OSError as e:
+                    # Nothing is lost yet, the buffered loop can take over
+                    if e.errno not in ZERO_COPY_ERRORS:
+                        raise
+                    self._use_splice = False
+                    break
+                if count == 0:
+                    raise ConnectionError("Connection closed while receiving data")
+                length -= count
+                if on_progress is not None:
+                    on_progress(count)
+                self._drain_pipe(f, count)
+        finally:
+            # Let python know where the file descriptor is now
+            f.seek(os.lseek(f.fileno(), 0, os.SEEK_CUR))
+        return length
+
+    def _drain_pipe(self, f, count: int):
+        """move `count` bytes from the pipe into the file"""
+        pipe_out = self._pipe[0]
+        while count > 0 and self._use_splice:
+            try:
+                count -= os.splice(pipe_out, f.fileno(), count, flags=os.SPLICE_F_MOVE)
+            except OSError as e:
+                # The file system doesn't support splice, copy the rest of the pipe through python
+                if e.errno not in ZERO_COPY_ERRORS:
+                    raise
+                self._use_splice = False
+        while count > 0:
+            data = memoryview(os.read(pipe_out, count))
+            count -= len(data)
+            while data:
+                data = data[os.write(f.fileno(), data):]
+
+    def close(self):
+        """close the pipe used for splicing"""
+        if self._pipe is not None:
+            os.close(self._pipe[0])
+            os.close(self._pipe[1])
+            self._pipe = None
+
+
+class FileWriter:
+    """writes received data to files on its own thread, so the socket is still drained while the disk is busy.
+    The receiving thread fills one of `buffers` buffers at a time and hands it over, receiving only waits for the disk
+    when all of them are waiting to be written"""
+
+    def __init__(self, buffer_size: int, buffers: int):
+        self._free = Queue()
+        for _ in range(buffers):
+            self._free.put(memoryview(bytearray(buffer_size)))
+        # Decompressed chunks don't come from the free buffers, so the queue itself is bounded as well
+        self._writes = Queue(maxsize=buffers)
+        # The first error since the last wait, later data is received but not written anymore
+        self._error = None
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def get_buffer(self) -> memoryview:
+        """wait for a buffer that isn't waiting to be written"""
+        return self._free.get()
+
+    def write(self, f, data, buffer: memoryview = None):
+        """write `data` to the opened file on the writer thread, `buffer` is given back once it's written"""
+        self._writes.put((f, data, buffer))
+
+    def wait(self):
+        """wait until everything that was handed over is written, raises the first error that happened meanwhile"""
+        self._writes.join()
+        (error, self._error) = (self._error, None)
+        if error is not None:
+            raise error
+
+    def close(self):
+        self._writes.put(None)
+
+    def _run(self):
+        while (item := self._writes.get()) is not None:
+            (f, data, buffer) = item
+            try:
+                if self._error is None:
+                    f.write(data)
+            except (OSError, ValueError) as e:
+                # ValueError when the file was closed because receiving it failed
+                self._error = e
+            finally:
+                if buffer is not None:
+                    self._free.put(buffer)
+                self._writes.task_done()
+
+
+def format_size(size: float) -> str:
+    """format an amount of bytes for humans"""
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1000:
+            return f"{size:.1f}{unit}"
+        size /= 1000
+    return f"{size:.1f}TB"
+
+
+# Compression
+
+def get_codec(codec_id: int) -> tuple:
+    """get the codec with an id that was received from the other side"""
+    if codec_id not in CODEC_NAMES:
+        raise ValueError(f"Unknown compression codec {codec_id}")
+    return CODECS[CODEC_NAMES[codec_id]]
+
+def choose_codec(offered: str | None) -> str | None:
+    """choose the first codec of a comma separated list of names that is available here"""
+    for name in (offered or "").split(","):
+        if name in CODECS:
+            return name
+    return None
+
+def is_compressible(path: str, f) -> bool:
+    """guess if compressing a file is worth it from its extension and the entropy of its first bytes"""
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return False
+
+    sample = f.read(COMPRESSION_SAMPLE_SIZE)
+    f.seek(0)
+    if not sample:
+        return False
+    entropy = -sum(count / len(sample) * math.log2(count / len(sample)) for count in Counter(sample).values())
+    return entropy < COMPRESSION_MAX_ENTROPY
+
+def send_compressed_contents(socket: socket.socket, f, length: int, codec: str, on_progress=None, throttle=None) -> tuple[int, int, float]:
+    """send exactly `length` bytes of an opened file as compressed chunks. Chunks that don't get smaller are sent as they are.
+    `throttle` is called with the size of every chunk on the wire before it's sent. Returns the amount of bytes read from the file, the amount of bytes sent and the cpu time spent compressing"""
+    (_, compress, _) = CODECS[codec]
+    offset = 0
+    read = 0
+    sent = 0
+    cpu_time = 0.0
+    misses = 0
+    while offset < length:
+        size = min(length - offset, COMPRESSION_CHUNK_SIZE)
+        data = f.read(size)
+        read += len(data)
+        # Fill up with zeros when the file got shorter than announced
+        if len(data) < size:
+            data += bytes(size - len(data))
+
+        # Stop trying when the file turns out to be incompressible after all
+        compressed = data
+        if misses < COMPRESSION_MAX_MISSES:
+            start = time.thread_time()
+            compressed = compress(data)
+            cpu_time += time.thread_time() - start
+            misses = misses + 1 if len(compressed) > size * 0.9 else 0
+            # A chunk with the same length before and after compressing is sent as it is
+            if len(compressed) >= size:
+                compressed = data
+
+        if throttle is not None:
+            throttle(COMPRESSION_CHUNK_HEADER.size + len(compressed))
+        socket.sendall(COMPRESSION_CHUNK_HEADER.pack(len(compressed), size) + compressed)
+        offset += size
+        sent += COMPRESSION_CHUNK_HEADER.size + len(compressed)
+        if on_progress is not None:
+            on_progress(size)
+    return (read, sent, cpu_time)
+
+
+# Field encoding
+
+def encode_varint(value: int) -> bytes:
+    """encode a non-negative integer in as few bytes as possible, 7 bits per byte"""
+    data = bytearray()
+    while value > 0x7f:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+def decode_varint(data: bytes, offset: int) -> tuple[int, int]:
+    """decode a varint at `offset` and return its value and the offset after it"""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return (value, offset)
+        shift += 7
+
+def encode_fields(fields: dict) -> bytes:
+    """encode a flat dictionary with string keys and None, bool, int, str or bytes values"""
+    data = bytearray()
+    for (key, value) in fields.items():
+        key = key.encode(FORMAT)
+        data += encode_varint(len(key))
+        data += key
+
+        if value is None:
+            data.append(FIELD_NONE)
+        elif value is True:
+            data.append(FIELD_TRUE)
+        elif value is False:
+            data.append(FIELD_FALSE)
+        elif type(value) == int:
+            # zigzag encoding so negative numbers stay small as well
+            data.append(FIELD_INT)
+            data += encode_varint(value << 1 if value >= 0 else (-value << 1) - 1)
+        else:
+            if type(value) == str:
+                data.append(FIELD_STR)
+                value = value.encode(FORMAT)
+            else:
+                data.append(FIELD_BYTES)
+            data += encode_varint(len(value))
+            data += value
+    return bytes(data)
+
+def decode_fields(data: bytes) -> dict:
+    """decode the fields made by `encode_fields`"""
+    fields = {}
+    offset = 0
+    while offset < len(data):
+        (length, offset) = decode_varint(data, offset)
+        key = data[offset:offset + length].decode(FORMAT)
+        offset += length
+
+        tag = data[offset]
+        offset += 1
+        if tag == FIELD_NONE:
+            value = None
+        elif tag == FIELD_TRUE:
+            value = True
+        elif tag == FIELD_FALSE:
+            value = False
+        elif tag == FIELD_INT:
+            (value, offset) = decode_varint(data, offset)
+            value = value >> 1 if value & 1 == 0 else -((value + 1) >> 1)
+        elif tag == FIELD_STR or tag == FIELD_BYTES:
+            (length, offset) = decode_varint(data, offset)
+            value = data[offset:offset + length]
+            offset += length
+            if tag == FIELD_STR:
+                value = value.decode(FORMAT)
+        else:
+            raise ValueError(f"Unknown field type {tag}")
+        fields[key] = value
+    return fields
+
+
+# Resuming transfers
+
+def chain_hash(previous: str, f, start: int, end: int) -> str:
+    """continue the hash of the first `start` bytes of an opened file to the first `end` bytes. The hash of every segment
+    starts with the hash before it, so it can be saved at a checkpoint and continued after a restart"""
+    digest = hashlib.new(HASH_ALGORITHM, bytes.fromhex(previous))
+    f.seek(start)
+    while start < end:
+        data = f.read(min(end - start, HASH_BUFFER_SIZE))
+        if not data:
+            raise ValueError("File is shorter than the part to hash")
+        digest.update(data)
+        start += len(data)
+    return digest.hexdigest()
+
+def prefix_hash(f, length: int) -> str:
+    """hash the first `length` bytes of an opened file the same way the receiver does at its checkpoints"""
+    digest = ""
+    for start in range(0, length, RESUME_CHECKPOINT):
+        digest = chain_hash(digest, f, start, min(start + RESUME_CHECKPOINT, length))
+    return digest
+
+
+# Bundles
+
+def encode_bundle(header: dict, entries: list) -> bytes:
+    """join encoded entries into a bundle that starts with its own header fields"""
+    header = encode_fields(header)
+    return encode_varint(len(header)) + header + b''.join(entries)
+
+def encode_bundle_entry(fields: dict, data: bytes = b'') -> bytes:
+    """encode a directory or small file for a bundle, files carry their length in the 'file-length' field"""
+    fields = encode_fields(fields)
+    return encode_varint(len(fields)) + fields + data
+
+def decode_bundle(payload: bytes) -> tuple[dict, object]:
+    """decode the header of a bundle and iterate over its entries as fields and a view of the file contents"""
+    (length, offset) = decode_varint(payload, 0)
+    return (decode_fields(payload[offset:offset + length]), _decode_bundle_entries(payload, offset + length))
+
+def _decode_bundle_entries(payload: bytes, offset: int):
+    view = memoryview(payload)
+    while offset < len(view):
+        (length, offset) = decode_varint(view, offset)
+        fields = decode_fields(bytes(view[offset:offset + length]))
+        offset += length
+        size = fields.get("file-length", 0)
+        yield (fields, view[offset:offset + size])
+        offset += size
+
+
+# File stuff
+
+def hash_file(path: str) -> str:
+    """get the hex digest of the contents of a file"""
+    digest = hashlib.new(HASH_ALGORITHM)
+    with open(path, 'rb') as f:
+        while data := f.read(HASH_BUFFER_SIZE):
+            digest.update(data)
+    return digest.hexdigest()
+
+def scan_tree(root: str, prune=None, workers: int = SCAN_WORKERS):
+    """yield the relative path and `os.DirEntry` of everything below `root` while threads keep reading directories.
+    The entries of files are already stat'ed by the threads, so `entry.stat()` doesn't touch the disk again.
+    `prune(relative_path, entry)` is called from the threads and skips entries for which it returns True, pruned
+    directories aren't read. There is no order between directories, but a directory always comes before its contents.
+    Errors raised by `prune` stop the scan and are raised again from here"""
+    chunks = Queue(maxsize=SCAN_QUEUE_SIZE)
+    directories = Queue()
+    # Directories that are queued or being read, the scan is done when none are left
+    pending = [1]
+    lock = Lock()
+    stopped = Event()
+
+    def hand_over(chunk: list, subdirectories: list):
+        # Directories are only read once their own entry is handed over, so it comes before their contents
+        chunks.put(chunk)
+        with lock:
+            pending[0] += len(subdirectories)
+        for item in subdirectories:
+            directories.put(item)
+
+    def scan(directory: str, prefix: str):
+        (chunk, subdirectories) = ([], [])
+        try:
+            with os.scandir(directory) as iterator:
+                for entry in iterator:
+                    if stopped.is_set():
+                        return
+                    relative_path = prefix + entry.name
+                    if prune is not None and prune(relative_path, entry):
+                        continue
+                    # Symbolic links to directories are listed but not followed, like os.walk does
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append((entry.path, relative_path + '/'))
+                    else:
+                        try:
+                            entry.stat()
+                        except OSError:
+                            # Gone already or a broken link
+                            continue
+                    chunk.append((relative_path, entry))
+                    if len(chunk) >= SCAN_CHUNK_SIZE:
+                        hand_over(chunk, subdirectories)
+                        (chunk, subdirectories) = ([], [])
+        except OSError:
+            # Directories that are gone or can't be read are skipped, like os.walk does
+            pass
+        if chunk:
+            hand_over(chunk, subdirectories)
+
+    def work():
+        while (item := directories.get()) is not None:
+            try:
+                scan(*item)
+            except BaseException as e:
+                # Raised again by the consumer instead of leaving it waiting for a scan that never finishes
+                stopped.set()
+                chunks.put(e)
+            finally:
+                with lock:
+                    pending[0] -= 1
+                    done = pending[0] == 0
+            if done:
+                chunks.put(None)
+                for _ in range(workers):
+                    directories.put(None)
+
+    directories.put((root, ''))
+    for _ in range(workers):
+        Thread(target=work, daemon=True).start()
+    try:
+        while (chunk := chunks.get()) is not None:
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield from chunk
+    finally:
+        # The caller stopped early, free the threads that wait for room in the queue
+        stopped.set()
+        while True:
+            try:
+                chunks.get_nowait()
+            except Empty:
+                break
+
+def preallocate(f, offset: int, length: int):
+    """reserve the disk space for the rest of a file before it's written, so it isn't fragmented and a full disk is
+    noticed before anything is received. Only raises when the disk is full"""
+    if not hasattr(os, "posix_fallocate") or length <= 0:
+        return
+    try:
+        os.posix_fallocate(f.fileno(), offset, length)
+    except OSError as e:
+        # The filesystem doesn't support it
+        if e.errno == errno.ENOSPC:
+            raise
+
+def clone_file(source: str, destination: str, hardlink=False) -> str:
+    """create `destination` with the contents of `source` without copying them through python. Hard links are only
+    made when asked, because changing one of the files in place changes the other one as well.
+    Returns how the file was made: hardlink, reflink or copy"""
+    if hardlink:
+        try:
+            os.link(source, destination)
+            return "hardlink"
+        except OSError:
+            # Other filesystem or no hard links there, copy instead
+            pass
+
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        if reflink(src, dst):
+            return "reflink"
+    # Uses sendfile on linux, so the kernel still does the copying
+    shutil.copyfile(source, destination)
+    return "copy"
+
+def reflink(source, destination) -> bool:
+    """let the opened file `destination` share the blocks of `source`, so it has the same contents without copying them.
+    Only filesystems with copy on write like btrfs and xfs support this. Returns if it worked"""
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        return True
+    except OSError:
+        return False
+
+def conflict_path(path: str, origin: str) -> str:
+    """get the path that keeps the version of `origin` when a file changed on the client and the server at the same time.
+    Both sides have to come up with the same path"""
+    (root, extension) = os.path.splitext(path)
+    return f"{root}.conflict-{NAME_PATTERN.sub('_', origin)}{extension}"
+
+
+# Delta transfers
+
+def delta_block_size(size: int) -> int:
+    """choose the block size of a signature for a file of `size` bytes"""
+    block_size = int(size ** 0.5) & ~0x3ff
+    return min(max(block_size, DELTA_MIN_BLOCK_SIZE), DELTA_MAX_BLOCK_SIZE)
+
+def strong_checksum(data) -> str:
+    """the strong checksum of a block to confirm a match of the weak rolling checksum"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def compute_signature(path: str) -> dict:
+    """get the weak and strong checksum of every block of a file"""
+    size = os.path.getsize(path)
+    block_size = delta_block_size(size)
+    blocks = []
+    with open(path, 'rb') as f:
+        while block := f.read(block_size):
+            blocks.append([zlib.adler32(block), strong_checksum(block)])
+    return {
+        "file-length": size,
+        "block-size": block_size,
+        "blocks": blocks
+    }
+
+def compute_delta(f, length: int, signature: dict) -> list | None:
+    """compare the first `length` bytes of an opened file with the signature of the old file and return a list of copy
+    and literal instructions. Literal instructions are stored as (start, end) ranges of the file. The file is read in
+    windows, so it can change while it's read. None is returned if the delta is not worth it"""
+    block_size = signature["block-size"]
+    blocks = signature["blocks"]
+    if not blocks:
+        return None
+
+    # Lookup table from weak checksum to the strong checksums with that weak checksum
+    table = {}
+    for index, (weak, strong) in enumerate(blocks):
+        table.setdefault(weak, []).append((strong, index))
+    last_index = len(blocks) - 1
+    last_length = signature["file-length"] - last_index * block_size
+
+    instructions = []
+    def add_copy(index):
+        # Merge consecutive blocks into a single instruction
+        if instructions and instructions[-1][0] == DELTA_COPY and instructions[-1][1] + instructions[-1][2] == index:
+            instructions[-1] = (DELTA_COPY, instructions[-1][1], instructions[-1][2] + 1)
+        else:
+            instructions.append((DELTA_COPY, index, 1))
+
+    # The part of the file that is read, starting at `window_start`
+    (window, window_start, window_end) = (b'', 0, 0)
+    offset = 0
+    literal_start = 0
+    weak = None
+    while offset + block_size <= length:
+        # The block and the byte after it have to be in the window
+        if window_end < min(length, offset + block_size + 1):
+            window = read_range(f, offset, min(length, offset + max(DELTA_WINDOW_SIZE, block_size + 1)))
+            (window_start, window_end) = (offset, offset + len(window))
+        position = offset - window_start
+        if weak is None:
+            weak = zlib.adler32(window[position:position + block_size])
+
+        match = None
+        candidates = table.get(weak)
+        if candidates is not None:
+            strong = strong_checksum(window[position:position + block_size])
+            for (candidate, index) in candidates:
+                if candidate == strong and (index != last_index or last_length == block_size):
+                    match = index
+                    break
+
+        if match is not None:
+            if literal_start < offset:
+                instructions.append((DELTA_LITERAL, literal_start, offset))
+            add_copy(match)
+            offset += block_size
+            literal_start = offset
+            weak = None
+            continue
+
+        # Too much data without a match, the file probably got rewritten entirely
+        if offset - literal_start > DELTA_MAX_SCAN:
+            return None
+
+        # Roll the checksum one byte further
+        if offset + block_size < length:
+            removed = window[position]
+            a = ((weak & 0xffff) - removed + window[position + block_size]) % ADLER_MOD
+            b = ((weak >> 16) - block_size * removed + a - 1) % ADLER_MOD
+            weak = (b << 16) | a
+        offset += 1
+
+    # The last block of the old file can be shorter than the block size
+    tail = read_range(f, offset, length)
+    if offset < length and len(tail) == last_length and strong_checksum(tail) == blocks[last_index][1]:
+        if literal_start < offset:
+            instructions.append((DELTA_LITERAL, literal_start, offset))
+        add_copy(last_index)
+    elif literal_start < length:
+        instructions.append((DELTA_LITERAL, literal_start, length))
+
+    return instructions
+
+def delta_length(instructions: list) -> int:
+    """get the amount of bytes the encoded instructions take up"""
+    total = 0
+    for instruction in instructions:
+        if instruction[0] == DELTA_COPY:
+            total += 1 + DELTA_COPY_FORMAT.size
+        else:
+            total += 1 + DELTA_LITERAL_FORMAT.size + instruction[2] - instruction[1]
+    return total
+
+def send_delta(socket: socket.socket, f, instructions: list):
+    """send the encoded instructions, literal data is read from the opened file"""
+    for instruction in instructions:
+        if instruction[0] == DELTA_COPY:
+            socket.sendall(DELTA_COPY + DELTA_COPY_FORMAT.pack(instruction[1], instruction[2]))
+        else:
+            (_, start, end) = instruction
+            socket.sendall(DELTA_LITERAL + DELTA_LITERAL_FORMAT.pack(end - start))
+            while start < end:
+                count = min(end - start, HASH_BUFFER_SIZE)
+                socket.sendall(read_range(f, start, start + count))
+                start += count
+
+def apply_delta(receiver: Receiver, length: int, basis, block_size: int, output):
+    """receive `length` bytes of instructions and write the new file to `output` using the old file `basis`"""
+    while length > 0:
+        instruction = bytes(receiver.recv_exactly(1))
+        if instruction == DELTA_COPY:
+            (index, count) = DELTA_COPY_FORMAT.unpack(receiver.recv_exactly(DELTA_COPY_FORMAT.size))
+            length -= 1 + DELTA_COPY_FORMAT.size
+
+            basis.seek(index * block_size)
+            remaining = count * block_size
+            while remaining > 0 and (data := basis.read(min(remaining, HASH_BUFFER_SIZE))):
+                output.write(data)
+                remaining -= len(data)
+        elif instruction == DELTA_LITERAL:
+            (remaining,) = DELTA_LITERAL_FORMAT.unpack(receiver.recv_exactly(DELTA_LITERAL_FORMAT.size))
+            length -= 1 + DELTA_LITERAL_FORMAT.size + remaining
+            receiver.recv_into_file(output, remaining)
+        else:
+            raise ValueError(f"Unknown delta instruction {instruction}")
+
+def read_range(f, start: int, end: int) -> bytes:
+    """read the bytes from `start` up to `end` of an opened file. A file that got shorter in the meantime is padded
+    with zeros, the sender notices the change afterwards"""
+    f.seek(start)
+    data = f.read(end - start)
+    if len(data) < end - start:
+        data += bytes(end - start - len(data))
+    return data
+
 
 # Testing look how pretty!
 if __name__ == "__main__":